@@ -2,17 +2,88 @@
 
 from functools import wraps
 import flask
-from . import authdigest
+from . import authdigest, crypto
+from .request import getClientIP
 
 class FlaskRealmDigestDb(authdigest.RealmDigestDb):
+    """
+    Realm Digest Credentials Database with a Flask view decorator.
+
+    Optionally, a successful digest authentication issues a short-lived session ticket signed with
+    `crypto.dict2signed`, returned both as a cookie and in the `ticketHeader` response header.  Requests presenting a
+    valid ticket (in either place) skip digest verification and the 401 challenge entirely.
+
+    Tickets are revoked by `revokeUser`, which bumps the user's credential generation, and by changing or removing
+    the user.  Generations are kept in a `GenerationStore` created when tickets are enabled.
+
+    :param ticketLifetime: seconds a session ticket stays valid, None (the default) disables tickets.
+    :param ticketBindIP: only accept a ticket from the client IP it was issued to.
+    :param generationPath: file shared by every worker process through which a revocation reaches them all, in a
+        directory only the application's user can write to.  None (the default) keeps generations in this process,
+        which is only enough for a single worker process.
+    """
+    ticketCookie = 'auth-ticket'
+    ticketHeader = 'X-Auth-Ticket'
+    ticketPurpose = 'auth-ticket'
+
+    def __init__(self, realm, algorithm='md5', ticketLifetime=None, ticketBindIP=True, generationPath=None, **kw):
+        super(FlaskRealmDigestDb, self).__init__(realm, algorithm, **kw)
+        self.ticketLifetime = ticketLifetime
+        self.ticketBindIP = ticketBindIP
+        if ticketLifetime:
+            self.generations = self.newGenerationDb(generationPath)
+
+    def issueTicket(self, request, user):
+        data = {'p': self.ticketPurpose, 'r': self.realm, 'u': user, 'g': self.userGeneration(user)}
+        if self.ticketBindIP:
+            data['ip'] = getClientIP(request)
+        return crypto.dict2signed(data)
+
+    def checkTicket(self, request):
+        """Returns an approved AuthenticationResult for a valid ticket, otherwise None."""
+        ticket = request.headers.get(self.ticketHeader) or request.cookies.get(self.ticketCookie)
+        if not ticket:
+            return None
+
+        try:
+            data = crypto.signed2dict(ticket.encode('ascii'), self.ticketLifetime)
+        except Exception:
+            return None
+
+        user = data.get('u')
+        if data.get('p') != self.ticketPurpose or data.get('r') != self.realm or user not in self:
+            return None
+        elif data.get('g') != self.userGeneration(user):
+            return None
+        elif self.ticketBindIP and data.get('ip') != getClientIP(request):
+            return None
+
+        authResult = authdigest.AuthenticationResult(self)
+        authResult.username = user
+        request.authentication = authResult
+        return authResult.approve('ticket')
+
+    def setTicket(self, response, ticket):
+        response.headers[self.ticketHeader] = ticket
+        if self.ticketCookie:
+            response.set_cookie(self.ticketCookie, ticket, max_age=self.ticketLifetime, httponly=True)
+
     def requireAuth(self, f):
         @wraps(f)
         def decorated(*args, **kwargs):
             request = flask.request
-            if not self.isAuthenticated(request):
-                return self.challenge()
+            if self.ticketLifetime and self.checkTicket(request):
+                return f(*args, **kwargs)
 
-            return f(*args, **kwargs)
+            authResult = self.isAuthenticated(request)
+            if not authResult:
+                return authResult.challenge()
 
-        return decorated
+            if not self.ticketLifetime:
+                return f(*args, **kwargs)
+
+            response = flask.make_response(f(*args, **kwargs))
+            self.setTicket(response, self.issueTicket(request, authResult.username))
+            return response
 
+        return decorated
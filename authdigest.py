@@ -19,6 +19,13 @@ Usage
 
         return get_protected_response(request)
 
+Nonces are signed with a key derived from `settings.SECRET_KEY` and the realm, so a nonce issued by one worker process
+is honoured by the others; pass `nonceSecret` to use another key.  Nonces are reusable for `nonceTimeout` seconds,
+after which the challenge is sent with `stale=true` so clients re-hash without prompting for credentials.
+
+Credential generations, which revoke the session tickets of `auth.FlaskRealmDigestDb`, are kept in a
+`GenerationStore`.
+
 
 Copyright and Licensing
 =======================
@@ -32,7 +39,12 @@ which is
     :license: BSD, see LICENSE at https://github.com/shanewholloway/werkzeug/blob/master/LICENSE for further details.
 """
 
-import hashlib, os, weakref, werkzeug
+import collections, hashlib, hmac, json, os, settings, tempfile, threading, time, weakref, werkzeug
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 
 class RealmDigestDb(object):
@@ -45,11 +57,18 @@ class RealmDigestDb(object):
 
     :param realm: string identifing the hashing realm.
     :param algorthm: string identifying hash algorithm to use, default is 'md5'.
+    :param nonceSecret: key used to sign challenge nonces, by default derived from `settings.SECRET_KEY` and the
+        realm.  Every worker must use the same key so that a nonce issued by one process is accepted by the others.
+    :param nonceTimeout: number of seconds an issued nonce may be reused before clients are asked to re-hash.
     """
-    def __init__(self, realm, algorithm='md5'):
+    # Credential generations, a `GenerationStore`; None until something derived from the credentials needs revoking.
+    generations = None
+
+    def __init__(self, realm, algorithm='md5', nonceSecret=None, nonceTimeout=300):
         self.realm = realm
         self.alg = self.newAlgorithm(algorithm)
         self.db = self.newDb()
+        self.nonces = self.newNonceEngine(nonceSecret, nonceTimeout)
 
     @property
     def algorithm(self):
@@ -73,7 +92,11 @@ class RealmDigestDb(object):
 
     def addUser(self, user, password):
         r = self.alg.hashPassword(user, self.realm, password)
+        previous = self.db.get(user)
         self.db[user] = r
+        if previous is not None and previous != r:
+            # A changed password revokes whatever was issued under the old one.
+            self.revokeUser(user)
         return r
 
     def __contains__(self, user):
@@ -89,14 +112,35 @@ class RealmDigestDb(object):
         return self.addUser(user, password)
 
     def __delitem__(self, user):
-        return self.db.pop(user, None)
+        r = self.db.pop(user, None)
+        if r is not None:
+            self.revokeUser(user)
+        return r
 
     def newDb(self):
         return dict()
 
+    def newGenerationDb(self, path=None):
+        return GenerationStore(path)
+
+    def userGeneration(self, user):
+        """Returns the user's credential generation, which invalidates anything derived from older generations."""
+        if self.generations is None:
+            return 0
+        return self.generations.get(user, 0)
+
+    def revokeUser(self, user):
+        """Bumps the user's credential generation, revoking outstanding session tickets in every process sharing it."""
+        if self.generations is None:
+            return 0
+        return self.generations.bump(user)
+
     def newAlgorithm(self, algorithm):
         return DigestAuthentication(algorithm)
 
+    def newNonceEngine(self, secret, timeout):
+        return NonceEngine(self.realm, secret, timeout)
+
     def isAuthenticated(self, request, **kw):
         authResult = AuthenticationResult(self)
         request.authentication = authResult
@@ -111,12 +155,23 @@ class RealmDigestDb(object):
             return authResult.deny('unknown_user')
         elif not self.alg.verify(authorization, hashPass, request.method, **kw):
             return authResult.deny('invalid_password')
+
+        # The nonce is only checked once the digest matched, so `stale` is never offered for a bad password.  A nonce
+        # signed with another key, e.g. before the secret changed, is treated as stale too: the client knows the
+        # password and only needs a fresh nonce.
+        nonceStatus = self.nonces.check(authorization.nonce, authorization.nc)
+        if nonceStatus in (NonceEngine.STALE, NonceEngine.INVALID):
+            authResult.stale = True
+            return authResult.deny(nonceStatus)
+        elif nonceStatus != NonceEngine.VALID:
+            return authResult.deny(nonceStatus)
         else:
+            authResult.username = authorization.username
             return authResult.approve('success')
 
     challengeClass = werkzeug.Response
 
-    def challenge(self, response=None, status=401):
+    def challenge(self, response=None, status=401, stale=False):
         try:
             authReq = response.www_authenticate
         except AttributeError:
@@ -127,7 +182,7 @@ class RealmDigestDb(object):
                 response.status_code = status
             else: response.status = status
 
-        authReq.set_digest(self.realm, os.urandom(8).encode('hex'))
+        authReq.set_digest(self.realm, self.nonces.newNonce(), algorithm=self.alg.challengeAlgorithm, stale=stale)
         return response
 
 
@@ -140,6 +195,8 @@ class AuthenticationResult(object):
     authenticated = None
     reason = None
     status = 500
+    stale = False
+    username = None
 
     def __init__(self, authDb):
         self.authDb = weakref.ref(authDb)
@@ -169,7 +226,160 @@ class AuthenticationResult(object):
 
     def challenge(self, response=None, force=False):
         if force or not self:
-            return self.authDb().challenge(response, self.status)
+            return self.authDb().challenge(response, self.status, self.stale)
+
+
+class GenerationStore(object):
+    """
+    Per-user credential generations, kept in this process or shared between processes through a small JSON file.
+
+    Lookups are served from memory; the file is re-read when it has been replaced, checked at most every
+    `checkInterval` seconds.  `bump` serializes writers with an exclusive lock on `<path>.lock` and replaces the file
+    atomically, so concurrent bumps from different workers are never lost.  Whoever can write the file can restore
+    revoked tickets, so it must live in a directory only the application's user can write to.  Sharing a file needs
+    `fcntl`, i.e. a Unix host.
+
+    :param path: path of the generations file, None (the default) to keep generations in this process only.
+    :param checkInterval: seconds between checks for a replaced file.
+    """
+    def __init__(self, path=None, checkInterval=1):
+        if path is not None and fcntl is None:
+            raise ValueError('Sharing generations through {0} needs fcntl, which this platform lacks'.format(path))
+        self.path = path
+        self.checkInterval = checkInterval
+        self._generations = {}
+        self._identity = None
+        self._nextCheck = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return '<GenerationStore: {0} ({1} users)>'.format(self.path, len(self._generations))
+
+    def refresh(self):
+        """Re-reads the file if it has been replaced since it was last read."""
+        self._nextCheck = time.time() + self.checkInterval
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return
+        identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if identity != self._identity:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            # Swap by assignment so concurrent readers see either the old or the new generations.
+            self._generations, self._identity = json.loads(data) if data else {}, identity
+
+    def get(self, user, default=0):
+        if self.path is not None and time.time() >= self._nextCheck:
+            self.refresh()
+        return self._generations.get(user, default)
+
+    def bump(self, user):
+        """Increments and returns the user's generation."""
+        with self._lock:
+            if self.path is None:
+                r = self._generations[user] = self._generations.get(user, 0) + 1
+                return r
+
+            # O_NOFOLLOW: never create or lock the target of a symlink planted at the lock path.
+            lockFd = os.open(self.path + '.lock', os.O_WRONLY | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+            with os.fdopen(lockFd, 'a') as lockFile:
+                fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+                self.refresh()
+                generations = dict(self._generations)
+                r = generations[user] = generations.get(user, 0) + 1
+
+                directory = os.path.dirname(os.path.abspath(self.path))
+                fd, tmpPath = tempfile.mkstemp(prefix='.{0}.'.format(os.path.basename(self.path)), dir=directory)
+                try:
+                    with os.fdopen(fd, 'wb') as f:
+                        json.dump(generations, f)
+                    os.rename(tmpPath, self.path)
+                except:
+                    if os.path.exists(tmpPath):
+                        os.unlink(tmpPath)
+                    raise
+                self.refresh()
+            return r
+
+
+class NonceEngine(object):
+    """
+    Stateless Digest Nonce Engine
+
+    Issues self-validating nonces of the form `<hex timestamp><hex hmac>`, where the HMAC covers the timestamp and
+    realm.  Any process holding the same secret can validate a nonce without server side storage, which lets clients
+    reuse a nonce for `timeout` seconds instead of paying for a 401 round trip on every request.
+
+    Nonce counts (`nc`) are tracked in a bounded in-memory LRU so that a replayed request is rejected.  A nonce which
+    has fallen out of the LRU is treated as unseen; the HMAC and timeout still bound how long it can be used.
+
+    :param realm: string identifing the hashing realm, mixed into every nonce.
+    :param secret: key used to sign nonces, defaults to one derived from `settings.SECRET_KEY` and the realm.
+    :param timeout: number of seconds a nonce is accepted for.
+    :param maxTracked: maximum number of nonces whose `nc` is remembered.
+    """
+    VALID = 'valid'
+    STALE = 'stale_nonce'
+    INVALID = 'invalid_nonce'
+    REPLAYED = 'replayed_nonce'
+
+    timestampLength = 8
+
+    def __init__(self, realm, secret=None, timeout=300, maxTracked=10000):
+        self.realm = realm
+        self.secret = secret or self.defaultSecret(realm)
+        self.timeout = timeout
+        self.maxTracked = maxTracked
+        self._counts = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def defaultSecret(realm):
+        """Derives a nonce key from `settings.SECRET_KEY`, the same in every process sharing the settings."""
+        realm = realm.encode('utf-8') if isinstance(realm, unicode) else str(realm)
+        return hmac.new(settings.SECRET_KEY, 'authdigest-nonce:' + realm, hashlib.sha256).digest()
+
+    def _sign(self, timestamp):
+        return hmac.new(self.secret, '{0}:{1}'.format(timestamp, self.realm), hashlib.sha1).hexdigest()
+
+    def newNonce(self):
+        timestamp = '%0*x' % (self.timestampLength, int(time.time()))
+        return timestamp + self._sign(timestamp)
+
+    def check(self, nonce, nc=None):
+        """Returns `VALID`, or one of `STALE`, `INVALID` or `REPLAYED` explaining why the nonce was refused."""
+        if not nonce or len(nonce) <= self.timestampLength:
+            return self.INVALID
+
+        timestamp, sig = nonce[:self.timestampLength], nonce[self.timestampLength:]
+        try:
+            issued = int(timestamp, 16)
+        except ValueError:
+            return self.INVALID
+
+        if isinstance(sig, unicode):
+            sig = sig.encode('utf-8')
+        if not hmac.compare_digest(sig, self._sign(timestamp)):
+            return self.INVALID
+        if time.time() - issued > self.timeout:
+            return self.STALE
+        if nc is None:
+            # No qop, so there is no counter to track.
+            return self.VALID
+
+        try:
+            count = int(nc, 16)
+        except ValueError:
+            return self.INVALID
+
+        with self._lock:
+            last = self._counts.pop(nonce, 0)
+            self._counts[nonce] = max(last, count)
+            if len(self._counts) > self.maxTracked:
+                self._counts.popitem(last=False)
+
+        return self.VALID if count > last else self.REPLAYED
 
 
 class DigestAuthentication(object):
@@ -185,11 +395,24 @@ class DigestAuthentication(object):
     def __init__(self, algorithm='md5'):
         self.algorithm = algorithm.lower()
         self.H = self.hashAlgorithms[self.algorithm]
+        self.sess = self.algorithm.endswith('-sess')
+        self._hA2Cache = {}
+        self._prefixCache = {}
+
+    # Upper bound on entries in each of the hA2 and `hA1:nonce:` prefix caches.  Caches are simply emptied when full.
+    maxCached = 4096
+
+    @property
+    def challengeAlgorithm(self):
+        """Algorithm token to advertise in the challenge, None for the RFC 2617 default and legacy 'sha'."""
+        if self.algorithm in ('md5', 'sha'):
+            return None
+        return self.algorithm.upper().replace('-SESS', '-sess')
 
     def verify(self, authorization, hashPass=None, method='GET', **kw):
         reqResponse = self.digest(authorization, hashPass, method, **kw)
         if reqResponse:
-            return authorization.response.lower() == reqResponse.lower()
+            return authorization.response.lower() == reqResponse
 
     def digest(self, authorization, hashPass=None, method='GET', **kw):
         if authorization is None:
@@ -199,12 +422,15 @@ class DigestAuthentication(object):
             hA1 = self._compute_hA1(authorization, kw['password'])
         else: hA1 = hashPass
 
+        if self.sess:
+            hA1 = self.H(hA1, authorization.nonce, authorization.cnonce)
+
         hA2 = self._compute_hA2(authorization, method)
 
-        if 'auth' in authorization.qop:
-            res = self._compute_qop_auth(authorization, hA1, hA2)
-        elif not authorization.qop:
+        if not authorization.qop:
             res = self._compute_qop_empty(authorization, hA1, hA2)
+        elif 'auth' in authorization.qop:
+            res = self._compute_qop_auth(authorization, hA1, hA2)
         else:
             raise ValueError('Unsupported qop: %r' % (authorization.qop,))
         return res
@@ -216,13 +442,35 @@ class DigestAuthentication(object):
         return self.hashPassword(auth.username, auth.realm, password or auth.password)
 
     def _compute_hA2(self, auth, method='GET'):
-        return self.H(method, auth.uri)
+        key = (method, auth.uri)
+        hA2 = self._hA2Cache.get(key)
+        if hA2 is None:
+            hA2 = self.H(method, auth.uri)
+            if len(self._hA2Cache) >= self.maxCached:
+                self._hA2Cache.clear()
+            self._hA2Cache[key] = hA2
+        return hA2
+
+    def _prefixState(self, hA1, nonce):
+        """Returns a fresh copy of the hash state after `hA1:nonce:`, which is stable while a nonce is reused."""
+        key = (hA1, nonce)
+        state = self._prefixCache.get(key)
+        if state is None:
+            state = self.H.new(_toBytes(hA1) + ':' + _toBytes(nonce) + ':')
+            if len(self._prefixCache) >= self.maxCached:
+                self._prefixCache.clear()
+            self._prefixCache[key] = state
+        return state.copy()
 
     def _compute_qop_auth(self, auth, hA1, hA2):
-        return self.H(hA1, auth.nonce, auth.nc, auth.cnonce, auth.qop, hA2)
+        h = self._prefixState(hA1, auth.nonce)
+        h.update(':'.join((_toBytes(auth.nc), _toBytes(auth.cnonce), _toBytes(auth.qop), hA2)))
+        return h.hexdigest()
 
     def _compute_qop_empty(self, auth, hA1, hA2):
-        return self.H(hA1, auth.nonce, hA2)
+        h = self._prefixState(hA1, auth.nonce)
+        h.update(hA2)
+        return h.hexdigest()
 
     hashAlgorithms = {}
 
@@ -230,13 +478,52 @@ class DigestAuthentication(object):
     def addDigestHashAlg(klass, key, hashObj):
         key = key.lower()
         def H(*args):
-            x = ':'.join(map(str, args))
+            try:
+                x = ':'.join(args)
+            except (TypeError, UnicodeError):
+                x = ':'.join([_toBytes(arg) for arg in args])
+            if isinstance(x, unicode):
+                x = x.encode('utf-8')
             return hashObj(x).hexdigest()
 
         H.__name__ = 'H_' + key
+        H.new = hashObj
         klass.hashAlgorithms[key] = H
         return H
 
+    @classmethod
+    def addDigestSessAlg(klass, key):
+        """Registers the `-sess` variant of an already registered algorithm (RFC 2617 3.2.2.2, RFC 7616 3.4.2)."""
+        key = key.lower()
+        H = klass.hashAlgorithms[key]
+        klass.hashAlgorithms[key + '-sess'] = H
+        return H
+
+
+def _toBytes(value):
+    if isinstance(value, str):
+        return value
+    elif isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _hashlibConstructor(name):
+    """Returns a constructor for an OpenSSL-provided digest, or None if this build of hashlib lacks it."""
+    try:
+        hashlib.new(name)
+    except ValueError:
+        return None
+    return lambda data='': hashlib.new(name, data)
+
+
 DigestAuthentication.addDigestHashAlg('md5', hashlib.md5)
 DigestAuthentication.addDigestHashAlg('sha', hashlib.sha1)
-
+DigestAuthentication.addDigestHashAlg('sha-256', hashlib.sha256)
+DigestAuthentication.addDigestSessAlg('md5')
+DigestAuthentication.addDigestSessAlg('sha-256')
+
+# SHA-512/256 uses its own initial values, so it cannot be derived from sha512 and is only offered when OpenSSL has it.
+if _hashlibConstructor('sha512_256') is not None:
+    DigestAuthentication.addDigestHashAlg('sha-512-256', _hashlibConstructor('sha512_256'))
+    DigestAuthentication.addDigestSessAlg('sha-512-256')
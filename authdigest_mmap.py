@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+Memory-mapped credential storage for :class:`~flashk_util.authdigest.RealmDigestDb`.
+
+Credentials are kept in a read-only file of raw digest bytes sorted by username.  The file is mapped into memory rather
+than parsed, so every worker on a host shares the same pages through the page cache, startup does not depend on the
+number of users, and lookups are a binary search over the mapped index.
+
+
+Usage
+=====
+
+    from flashk_util.authdigest_mmap import MappedDigestStore, MappedRealmDigestDb
+
+    # Offline, from the output of RealmDigestDb.toJson():
+    MappedDigestStore.importJson('/var/lib/app/users.db', open('users.json').read())
+
+    # In each worker:
+    authDb = MappedRealmDigestDb('/var/lib/app/users.db')
+
+Rebuilding the file is atomic: the new file is written next to the old one and renamed over it.  Open stores notice the
+new file within `checkInterval` seconds and map it in place of the old one.
+
+
+File layout
+===========
+
+    header   '<4sBHIHH': magic, version, digest size, user count, realm length, algorithm length
+    realm    utf-8 bytes
+    alg      ascii bytes
+    index    count * '<IH': offset of the username in the key blob, username length
+    digests  count * digest size raw bytes, in index order
+    keys     utf-8 usernames, in index order
+"""
+
+import binascii, collections, mmap, os, struct, tempfile, time
+from . import authdigest
+
+_magic = 'FKDB'
+_version = 1
+_header = struct.Struct('<4sBHIHH')
+_entry = struct.Struct('<IH')
+
+
+def _encodeKey(user):
+    return user.encode('utf-8') if isinstance(user, unicode) else str(user)
+
+
+class _MappedFile(object):
+    """A single mapped generation of the credentials file."""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime, stat.st_size)
+
+        magic, version, self.digestSize, self.count, realmLen, algLen = _header.unpack_from(self.mm, 0)
+        if magic != _magic or version != _version:
+            raise ValueError('{0} is not a credentials file (magic={1!r}, version={2!r})'.format(path, magic, version))
+
+        offset = _header.size
+        self.realm = self.mm[offset:offset + realmLen].decode('utf-8')
+        offset += realmLen
+        self.algorithm = self.mm[offset:offset + algLen]
+        offset += algLen
+
+        self.indexStart = offset
+        self.digestsStart = self.indexStart + self.count * _entry.size
+        self.keysStart = self.digestsStart + self.count * self.digestSize
+
+    def key(self, i):
+        offset, length = _entry.unpack_from(self.mm, self.indexStart + i * _entry.size)
+        start = self.keysStart + offset
+        return self.mm[start:start + length]
+
+    def digest(self, i):
+        start = self.digestsStart + i * self.digestSize
+        return binascii.hexlify(self.mm[start:start + self.digestSize])
+
+    def find(self, key):
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            candidate = self.key(mid)
+            if candidate < key:
+                lo = mid + 1
+            elif candidate > key:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+
+class MappedDigestStore(collections.Mapping):
+    """
+    Read-only mapping of username to hex digest backed by a memory-mapped file.
+
+    :param path: path of a file written by `build`.
+    :param checkInterval: seconds between checks for a rebuilt file, `None` disables reloading.
+    """
+    def __init__(self, path, checkInterval=5):
+        self.path = path
+        self.checkInterval = checkInterval
+        self._file = _MappedFile(path)
+        self._nextCheck = time.time() + (checkInterval or 0)
+
+    def __repr__(self):
+        return '<MappedDigestStore: {0} ({1} users)>'.format(self.path, len(self))
+
+    @property
+    def realm(self):
+        return self._file.realm
+
+    @property
+    def algorithm(self):
+        return self._file.algorithm
+
+    def refresh(self):
+        """Maps the file at `path` if it has been replaced since it was last mapped.  Returns True on reload."""
+        self._nextCheck = time.time() + (self.checkInterval or 0)
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return False
+
+        if (stat.st_ino, stat.st_mtime, stat.st_size) == self._file.identity:
+            return False
+
+        # Swap by assignment so concurrent readers see either the old or the new file, never a mix.  The previous map
+        # is released once the last reader drops its reference.
+        self._file = _MappedFile(self.path)
+        return True
+
+    def _current(self):
+        if self.checkInterval is not None and time.time() >= self._nextCheck:
+            self.refresh()
+        return self._file
+
+    def get(self, user, default=None):
+        f = self._current()
+        i = f.find(_encodeKey(user))
+        return f.digest(i) if i >= 0 else default
+
+    def __getitem__(self, user):
+        r = self.get(user)
+        if r is None:
+            raise KeyError(user)
+        return r
+
+    def __contains__(self, user):
+        return self._current().find(_encodeKey(user)) >= 0
+
+    def __len__(self):
+        return self._file.count
+
+    def __iter__(self):
+        f = self._file
+        for i in xrange(f.count):
+            yield f.key(i).decode('utf-8')
+
+    def iteritems(self):
+        f = self._file
+        for i in xrange(f.count):
+            yield f.key(i).decode('utf-8'), f.digest(i)
+
+    @staticmethod
+    def build(path, items, realm='', algorithm=''):
+        """
+        Writes a credentials file from an iterable of `(user, hexdigest)` pairs and atomically renames it to `path`.
+        """
+        entries = sorted((_encodeKey(user), binascii.unhexlify(digest)) for user, digest in items)
+        digestSize = len(entries[0][1]) if entries else 0
+        realm = realm.encode('utf-8')
+        algorithm = str(algorithm)
+
+        index, digests, keys, offset = [], [], [], 0
+        for key, digest in entries:
+            if len(digest) != digestSize:
+                raise ValueError('Digest for user {0!r} has {1} bytes, expected {2}'.format(
+                    key, len(digest), digestSize))
+            index.append(_entry.pack(offset, len(key)))
+            digests.append(digest)
+            keys.append(key)
+            offset += len(key)
+
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmpPath = tempfile.mkstemp(prefix='.{0}.'.format(os.path.basename(path)), dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_header.pack(_magic, _version, digestSize, len(entries), len(realm), len(algorithm)))
+                f.write(realm)
+                f.write(algorithm)
+                f.write(''.join(index))
+                f.write(''.join(digests))
+                f.write(''.join(keys))
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmpPath, path)
+        except:
+            if os.path.exists(tmpPath):
+                os.unlink(tmpPath)
+            raise
+
+    @classmethod
+    def importDict(klass, path, data):
+        """Builds a credentials file from the output of `RealmDigestDb.toDict`."""
+        cfg = data.get('cfg', {})
+        klass.build(path, data['db'].iteritems(), cfg.get('realm', ''), cfg.get('algorithm', ''))
+
+    @classmethod
+    def importJson(klass, path, data):
+        """Builds a credentials file from the output of `RealmDigestDb.toJson`."""
+        import json
+        klass.importDict(path, json.loads(data))
+
+
+class MappedRealmDigestDb(authdigest.RealmDigestDb):
+    """
+    Realm Digest Credentials Database backed by a `MappedDigestStore`.
+
+    The realm and algorithm default to the values recorded in the file.  The database is read-only; to change
+    credentials rebuild the file with `MappedDigestStore.build` and open stores pick it up automatically.
+
+    :param path: path of the credentials file.
+    :param checkInterval: seconds between checks for a rebuilt file, `None` disables reloading.
+    """
+    def __init__(self, path, realm=None, algorithm=None, checkInterval=5, **kw):
+        self.store = MappedDigestStore(path, checkInterval)
+        realm = self.store.realm if realm is None else realm
+        algorithm = (self.store.algorithm or 'md5') if algorithm is None else algorithm
+        if self.store.realm and self.store.realm != realm:
+            raise ValueError('Realm {0!r} does not match {1!r} recorded in {2}'.format(realm, self.store.realm, path))
+        if self.store.algorithm and self.store.algorithm != algorithm.lower():
+            raise ValueError('Algorithm {0!r} does not match {1!r} recorded in {2}'.format(
+                algorithm, self.store.algorithm, path))
+        super(MappedRealmDigestDb, self).__init__(realm, algorithm, **kw)
+
+    @property
+    def path(self):
+        return self.store.path
+
+    def newDb(self):
+        return self.store
+
+    def toDict(self):
+        r = super(MappedRealmDigestDb, self).toDict()
+        r['db'] = dict(self.db.iteritems())
+        return r
+
+    def addUser(self, user, password):
+        raise TypeError('{0} is read-only, rebuild it with MappedDigestStore.build()'.format(self.path))
+
+    def __delitem__(self, user):
+        raise TypeError('{0} is read-only, rebuild it with MappedDigestStore.build()'.format(self.path))
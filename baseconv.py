@@ -37,6 +37,25 @@ Sample usage::
   >>> base11.decode('$-22')
   '$1234'
 
+Fixed width output and bulk conversion::
+
+  >>> base62.encode(61, width=4)
+  '000z'
+  >>> base62.encode_many([61, 62])
+  ['z', '10']
+  >>> base62.decode_many(['z', '10'])
+  [61, 62]
+
+NumPy integer arrays passed to `encode_many`, and NumPy bytes arrays passed to `decode_many`, are converted with
+vectorized arithmetic.
+
+Byte strings keep their leading zero bytes::
+
+  >>> base62.encode_bytes('\\x00\\xff')
+  '047'
+  >>> base62.decode_bytes('047')
+  '\\x00\\xff'
+
 """
 
 BASE2_ALPHABET = '01'
@@ -46,6 +65,13 @@ BASE36_ALPHABET = '0123456789abcdefghijklmnopqrstuvwxyz'
 BASE62_ALPHABET = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
 BASE64_ALPHABET = BASE62_ALPHABET + '-_'
 
+import binascii
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class BaseConverter(object):
     decimal_digits = '0123456789'
 
@@ -54,21 +80,115 @@ class BaseConverter(object):
         self.digits = digits
         if sign in self.digits:
             raise ValueError('Sign character found in converter base digits.')
+        self.base = len(digits)
+        self.values = dict((digit, value) for value, digit in enumerate(digits))
+        # Digits per leaf of the divide-and-conquer conversion, chosen so a leaf fits in a machine word.
+        self._leafDigits = 1
+        while self.base ** (self._leafDigits + 1) < 2 ** 63:
+            self._leafDigits += 1
+        self._powers = []
 
     def __repr__(self):
         return "<BaseConverter: base%s (%s)>" % (len(self.digits), self.digits)
 
-    def encode(self, i):
-        neg, value = self.convert(i, self.decimal_digits, self.digits, '-')
+    def encode(self, i, width=None):
+        """
+        Encodes an integer (or a string of decimal digits).  With `width`, the digits are left padded with the zero
+        digit to at least that many characters, not counting the sign.
+        """
+        if isinstance(i, (int, long)) and not isinstance(i, bool):
+            neg, value = i < 0, self._encodeInt(-i if i < 0 else i)
+        else:
+            neg, value = self.convert(i, self.decimal_digits, self.digits, '-')
+        if width is not None and len(value) < width:
+            value = self.digits[0] * (width - len(value)) + value
         if neg:
             return self.sign + value
         return value
 
     def decode(self, s):
-        neg, value = self.convert(s, self.digits, self.decimal_digits, self.sign)
-        if neg:
-            value = '-' + value
-        return int(value)
+        # Like `convert`, accepts anything whose str() is the encoded value, e.g. an int of decimal digits.
+        s = str(s)
+        if not s:
+            raise ValueError('Cannot decode an empty string')
+        if s[:1] == self.sign:
+            neg, s = True, s[1:]
+        else:
+            neg = False
+        value = self._decodeInt(s)
+        return -value if neg else value
+
+    # Above these sizes conversion switches to divide-and-conquer, which keeps the per-digit loops on word sized
+    # integers and splits big ones with a handful of large divisions or multiplications.
+    largeIntBits = 512
+    largeStringDigits = 96
+
+    def _power(self, k):
+        """Returns base ** (leafDigits * 2 ** k), memoized by repeated squaring."""
+        powers = self._powers
+        if len(powers) <= k:
+            # Converters are shared between threads: extend a copy and swap it in whole, so a reader never sees a
+            # list another thread is appending to.
+            powers = list(powers) or [self.base ** self._leafDigits]
+            while len(powers) <= k:
+                powers.append(powers[-1] * powers[-1])
+            self._powers = powers
+        return powers[k]
+
+    def _encodeInt(self, x):
+        if x == 0:
+            return self.digits[0]
+        if x.bit_length() > self.largeIntBits:
+            return self._encodeLarge(x)
+        digits, base = self.digits, self.base
+        res = []
+        while x:
+            x, digit = divmod(x, base)
+            res.append(digits[digit])
+        res.reverse()
+        return ''.join(res)
+
+    def _encodeLarge(self, x):
+        k = 0
+        while self._power(k + 1) <= x:
+            k += 1
+        parts = []
+        self._encodeSplit(x, k, False, parts)
+        return ''.join(parts)
+
+    def _encodeSplit(self, x, k, pad, parts):
+        # Invariant: x < power(k) ** 2, and with `pad` the output is exactly 2 * leafDigits * 2 ** k digits.
+        if k < 0:
+            s = self._encodeInt(x)
+            parts.append(s.rjust(self._leafDigits, self.digits[0]) if pad else s)
+            return
+        hi, lo = divmod(x, self._power(k))
+        if hi or pad:
+            self._encodeSplit(hi, k - 1, pad, parts)
+            self._encodeSplit(lo, k - 1, True, parts)
+        else:
+            self._encodeSplit(lo, k - 1, False, parts)
+
+    def _decodeLarge(self, s):
+        if len(s) <= self.largeStringDigits:
+            return self._decodeInt(s)
+        k = 0
+        while self._leafDigits << (k + 1) < len(s):
+            k += 1
+        split = len(s) - (self._leafDigits << k)
+        return self._decodeLarge(s[:split]) * self._power(k) + self._decodeLarge(s[split:])
+
+    def _decodeInt(self, s):
+        if len(s) > self.largeStringDigits:
+            return self._decodeLarge(s)
+        values, base = self.values, self.base
+        x = 0
+        try:
+            for digit in s:
+                x = x * base + values[digit]
+        except KeyError as e:
+            raise ValueError('Invalid digit {0!r} for {1!r}'.format(e.args[0], self))
+        return x
 
     def convert(self, number, from_digits, to_digits, sign):
         if str(number)[0] == sign:
@@ -78,21 +198,129 @@ class BaseConverter(object):
             neg = 0
 
         # make an integer out of the number
-        x = 0
-        for digit in str(number):
-            x = x * len(from_digits) + from_digits.index(digit)
+        if from_digits is self.digits:
+            x = self._decodeInt(str(number))
+        else:
+            base = len(from_digits)
+            x = 0
+            for digit in str(number):
+                x = x * base + from_digits.index(digit)
 
         # create the result in base 'len(to_digits)'
-        if x == 0:
+        if to_digits is self.digits:
+            res = self._encodeInt(x)
+        elif x == 0:
             res = to_digits[0]
         else:
-            res = ''
+            res = []
+            base = len(to_digits)
             while x > 0:
-                digit = x % len(to_digits)
-                res = to_digits[digit] + res
-                x = int(x // len(to_digits))
+                x, digit = divmod(x, base)
+                res.append(to_digits[digit])
+            res = ''.join(reversed(res))
         return neg, res
 
+    def encode_bytes(self, data):
+        """
+        Encodes a byte string such as a UUID, hash or random token.  Each leading zero byte becomes a leading zero
+        digit, so `decode_bytes` restores the exact input.
+        """
+        stripped = data.lstrip('\0')
+        zeros = self.digits[0] * (len(data) - len(stripped))
+        if not stripped:
+            return zeros
+        return zeros + self._encodeInt(int(binascii.hexlify(stripped), 16))
+
+    def decode_bytes(self, s):
+        """Reverses `encode_bytes`."""
+        stripped = s.lstrip(self.digits[0])
+        zeros = '\0' * (len(s) - len(stripped))
+        if not stripped:
+            return zeros
+        value = '%x' % self._decodeInt(stripped)
+        return zeros + binascii.unhexlify('0' * (len(value) % 2) + value)
+
+    def encode_many(self, values, width=None):
+        """
+        Encodes a sequence of integers.  A NumPy integer array is encoded with vectorized arithmetic and returns a
+        NumPy bytes array; anything else returns a list.
+        """
+        if numpy is not None and isinstance(values, numpy.ndarray) and values.dtype.kind in 'iu':
+            return self._encodeArray(values, width)
+        encode = self.encode
+        return [encode(i, width) for i in values]
+
+    def decode_many(self, strings):
+        """
+        Decodes a sequence of encoded strings.  A NumPy bytes array is decoded with vectorized arithmetic into an int64
+        array when every value fits; anything else returns a list.
+        """
+        if numpy is not None and isinstance(strings, numpy.ndarray) and strings.dtype.kind == 'S':
+            decoded = self._decodeArray(strings)
+            if decoded is not None:
+                return decoded
+        decode = self.decode
+        return [decode(s) for s in strings]
+
+    def _digitTable(self):
+        return numpy.frombuffer(self.digits, dtype=numpy.uint8)
+
+    def _encodeArray(self, values, width):
+        values = values.ravel()
+        if values.dtype.kind == 'i':
+            neg = values < 0
+            # Negating in int64 wraps -2 ** 63 to itself, which is still its magnitude once viewed as uint64.
+            x = numpy.where(neg, -values.astype(numpy.int64), values).astype(numpy.uint64)
+        else:
+            # Unsigned values must not go through numpy.where with an int64, which would promote them to float64.
+            neg = None
+            x = values.astype(numpy.uint64)
+
+        largest = int(x.max()) if len(x) else 0
+        columns = len(self._encodeInt(largest))
+
+        codes = numpy.empty((len(x), columns), dtype=numpy.uint8)
+        table = self._digitTable()
+        base = numpy.uint64(self.base)
+        for column in xrange(columns - 1, -1, -1):
+            codes[:, column] = table[x % base]
+            x //= base
+
+        res = numpy.char.lstrip(codes.view('S{0}'.format(columns)).ravel(), self.digits[0])
+        res[res == ''] = self.digits[0]
+        if width is not None:
+            # Like `encode`, each value is padded on its own to at least `width` digits; numpy.char.rjust truncates to
+            # the width it is given, so never ask for fewer digits than a value has.
+            res = numpy.char.rjust(res, numpy.maximum(numpy.char.str_len(res), width), self.digits[0])
+        if neg is not None and neg.any():
+            res = numpy.where(neg, numpy.char.add(self.sign, res), res)
+        return res
+
+    def _decodeArray(self, strings):
+        strings = strings.ravel()
+        columns = strings.dtype.itemsize
+        # Beyond this many digits an int64 may overflow; let the caller fall back to Python integers.
+        if self.base ** columns > 2 ** 63:
+            return None
+
+        lookup = numpy.full(256, -1, dtype=numpy.int64)
+        lookup[self._digitTable()] = numpy.arange(self.base)
+        codes = numpy.ascontiguousarray(strings).view(numpy.uint8).reshape(len(strings), columns)
+
+        neg = codes[:, 0] == ord(self.sign) if columns else numpy.zeros(len(strings), dtype=bool)
+        x = numpy.zeros(len(strings), dtype=numpy.int64)
+        for column in xrange(columns):
+            c = codes[:, column]
+            # Shorter strings are padded with NULs; the sign only counts in the first column.
+            present = c != 0
+            if column == 0:
+                present &= ~neg
+            v = lookup[c]
+            if (v[present] < 0).any():
+                raise ValueError('Invalid digit for {0!r}'.format(self))
+            x = numpy.where(present, x * self.base + v, x)
+        return numpy.where(neg, -x, x)
+
 base2 = BaseConverter(BASE2_ALPHABET)
 base16 = BaseConverter(BASE16_ALPHABET)
 base36 = BaseConverter(BASE36_ALPHABET)
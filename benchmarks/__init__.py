@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmarks for flashk_util hot paths.
+
+Each module runs on its own and compares an implementation against its predecessor, e.g.:
+
+    python -m flashk_util.benchmarks.authdigest
+
+The regression suite in `suite` times every hot path against a local Flask test app, saves the results as a JSON
+baseline and fails when a later run regresses past a threshold:
+
+    python -m flashk_util.benchmarks --save baseline.json
+    python -m flashk_util.benchmarks --compare baseline.json --threshold 0.2
+"""
+
+import timeit
+
+
+def rate(func, number=10000, repeat=3):
+    """Returns the best observed calls per second of `func` over `repeat` runs of `number` calls."""
+    return number / min(timeit.repeat(func, number=number, repeat=repeat))
+
+
+def autorate(func, minTime=0.2, repeat=3):
+    """Like `rate`, with `number` grown until one run of `func` takes at least `minTime` seconds."""
+    number = 1
+    while True:
+        elapsed = timeit.timeit(func, number=number)
+        if elapsed >= minTime:
+            break
+        number *= 2 if elapsed * 10 >= minTime else 10
+    return max(number / elapsed, rate(func, number, repeat - 1) if repeat > 1 else 0)
+
+
+def report(name, before, after=None):
+    """Prints a calls-per-second line, with the speedup when a before/after pair is given."""
+    if after is None:
+        print '{0:<48} {1:>14,.0f}/s'.format(name, before)
+    else:
+        print '{0:<48} {1:>14,.0f}/s -> {2:>14,.0f}/s  x{3:.2f}'.format(name, before, after, after / before)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""Verifications per second of DigestAuthentication, against the original join-and-hash implementation."""
+
+from werkzeug.http import parse_authorization_header
+from .. import authdigest
+from . import rate, report
+
+
+class LegacyDigestAuthentication(authdigest.DigestAuthentication):
+    """The pre-caching implementation: every H() call joins `str()`-coerced arguments and hashes from scratch."""
+    def __init__(self, algorithm='md5'):
+        super(LegacyDigestAuthentication, self).__init__(algorithm)
+        hashObj = self.H.new
+        self.H = lambda *args: hashObj(':'.join(map(str, args))).hexdigest()
+
+    def _compute_hA2(self, auth, method='GET'):
+        return self.H(method, auth.uri)
+
+    def _compute_qop_auth(self, auth, hA1, hA2):
+        return self.H(hA1, auth.nonce, auth.nc, auth.cnonce, auth.qop, hA2)
+
+    def _compute_qop_empty(self, auth, hA1, hA2):
+        return self.H(hA1, auth.nonce, hA2)
+
+
+def authorizationFor(alg, user, realm, password, nonce, uri='/api/v1/contacts', method='GET'):
+    hA1 = alg.hashPassword(user, realm, password)
+    header = 'Digest username="{0}", realm="{1}", nonce="{2}", uri="{3}", qop=auth, nc=00000001, ' \
+        'cnonce="0a4f113b", response="{{0}}"'.format(user, realm, nonce, uri)
+    response = alg.digest(parse_authorization_header(header.format('')), hA1, method)
+    return parse_authorization_header(header.format(response)), hA1
+
+
+def main():
+    nonce = authdigest.NonceEngine('bench').newNonce()
+    for algorithm in sorted(authdigest.DigestAuthentication.hashAlgorithms):
+        legacy = LegacyDigestAuthentication(algorithm)
+        current = authdigest.DigestAuthentication(algorithm)
+        authorization, hA1 = authorizationFor(current, 'admin', 'bench', 'secret', nonce)
+        assert legacy.verify(authorization, hA1) and current.verify(authorization, hA1)
+
+        before = rate(lambda: legacy.verify(authorization, hA1, 'GET'))
+        after = rate(lambda: current.verify(authorization, hA1, 'GET'))
+        report('verify ({0})'.format(algorithm), before, after)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+"""
+base62 encode/decode throughput, against the original decimal-string round trip implementation, including byte strings
+from 8 to 4096 bytes.
+"""
+
+import binascii, os, time
+from .. import baseconv
+from . import rate, report
+
+
+def legacyConvert(number, from_digits, to_digits, sign):
+    if str(number)[0] == sign:
+        number = str(number)[1:]
+        neg = 1
+    else:
+        neg = 0
+    x = 0
+    for digit in str(number):
+        x = x * len(from_digits) + from_digits.index(digit)
+    if x == 0:
+        res = to_digits[0]
+    else:
+        res = ''
+        while x > 0:
+            digit = x % len(to_digits)
+            res = to_digits[digit] + res
+            x = int(x // len(to_digits))
+    return neg, res
+
+
+def legacyEncode(i):
+    return legacyConvert(i, baseconv.BaseConverter.decimal_digits, baseconv.BASE62_ALPHABET, '-')[1]
+
+
+def legacyDecode(s):
+    return int(legacyConvert(s, baseconv.BASE62_ALPHABET, baseconv.BaseConverter.decimal_digits, '-')[1])
+
+
+def main():
+    base62 = baseconv.base62
+    timestamp = int(time.time())
+    identifier = 2 ** 63 - 25
+    for label, value in (('timestamp', timestamp), ('64-bit id', identifier)):
+        encoded = base62.encode(value)
+        assert legacyEncode(value) == encoded and legacyDecode(encoded) == value
+        report('encode ({0})'.format(label), rate(lambda: legacyEncode(value)), rate(lambda: base62.encode(value)))
+        report('decode ({0})'.format(label), rate(lambda: legacyDecode(encoded)), rate(lambda: base62.decode(encoded)))
+
+    values = range(timestamp, timestamp + 10000)
+    encoded = base62.encode_many(values)
+    report('encode_many (10k, per value)', rate(lambda: [legacyEncode(i) for i in values], number=5) * 10000,
+        rate(lambda: base62.encode_many(values), number=5) * 10000)
+    report('decode_many (10k, per value)', rate(lambda: [legacyDecode(s) for s in encoded], number=5) * 10000,
+        rate(lambda: base62.decode_many(encoded), number=5) * 10000)
+
+    if baseconv.numpy is not None:
+        array = baseconv.numpy.array(values, dtype=baseconv.numpy.int64)
+        encodedArray = base62.encode_many(array)
+        report('encode_many (10k numpy, per value)', rate(lambda: base62.encode_many(values), number=5) * 10000,
+            rate(lambda: base62.encode_many(array), number=5) * 10000)
+        report('decode_many (10k numpy, per value)', rate(lambda: base62.decode_many(encoded), number=5) * 10000,
+            rate(lambda: base62.decode_many(encodedArray), number=5) * 10000)
+
+    for size in (8, 16, 32, 64, 128, 256, 512, 1024, 2048, 4096):
+        data = os.urandom(size)
+        encoded = base62.encode_bytes(data)
+        number = 5 if size >= 1024 else 200
+        assert legacyEncode(int(binascii.hexlify(data), 16)) == encoded.lstrip('0')
+        report('encode_bytes ({0} bytes)'.format(size),
+            rate(lambda: legacyEncode(int(binascii.hexlify(data), 16)), number=number),
+            rate(lambda: base62.encode_bytes(data), number=number))
+        report('decode_bytes ({0} bytes)'.format(size),
+            rate(lambda: '%x' % legacyDecode(encoded), number=number),
+            rate(lambda: base62.decode_bytes(encoded), number=number))
+
+
+if __name__ == '__main__':
+    main()
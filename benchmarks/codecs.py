@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""Encoded size and encode/decode throughput of the crypto payload codecs on representative session dicts."""
+
+from .. import crypto
+from . import rate, report
+
+sessions = {
+    'small': {'userId': 1234567, 'csrf': 'd41d8cd98f00b204e9800998ecf8427e'},
+    'medium': {
+        'userId': 1234567, 'accountId': 89012, 'csrf': 'd41d8cd98f00b204e9800998ecf8427e', 'tz': 'US/Pacific',
+        'roles': ['admin', 'billing', 'support'], 'flags': {'beta': True, 'mfa': False}, 'loginAt': 1412345678,
+    },
+    'large': {
+        'userId': 1234567, 'accountId': 89012, 'csrf': 'd41d8cd98f00b204e9800998ecf8427e', 'tz': 'US/Pacific',
+        'recentContacts': [{'id': 1000 + i, 'name': 'Contact {0}'.format(i), 'number': '+1415555{0:04d}'.format(i)}
+            for i in xrange(40)],
+        'groups': [{'id': i, 'name': 'Group {0}'.format(i), 'members': range(i, i + 10)} for i in xrange(10)],
+    },
+}
+
+
+def main():
+    for label, session in sorted(sessions.items()):
+        print '{0} session, {1} bytes of JSON'.format(label, len(crypto._jsonDumps(session)))
+        for codec in ['auto'] + sorted(crypto.codecsByName):
+            encoded = crypto.encodePayload(session, codec)
+            assert crypto.loadEncodedS(encoded) == crypto.loadEncodedS(crypto.encodePayload(session, 'zlib'))
+            report('  {0:<12} {1:>5} bytes  encode'.format(codec, len(encoded)),
+                rate(lambda: crypto.encodePayload(session, codec), number=2000))
+            report('  {0:<12} {1:>5} bytes  decode'.format(codec, len(encoded)),
+                rate(lambda: crypto.loadEncodedS(encoded), number=2000))
+
+
+if __name__ == '__main__':
+    main()
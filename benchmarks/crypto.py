@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+"""Signing and verification throughput of crypto.Signer, against rebuilding the salted HMAC on every call."""
+
+import settings, time, zlib, simplejson as json
+from .. import baseconv, crypto
+from . import rate, report
+
+
+def legacySignature(value):
+    return crypto.base64_hmac((settings.SALT + 'signer', value, settings.SECRET_KEY))
+
+
+def legacyDict2signed(data):
+    b64d = '.' + crypto.b64_encode(zlib.compress(json.dumps(data, separators=(',', ':'))))
+    value = '%s%s%s' % (b64d, ':', baseconv.base62.encode(int(time.time())))
+    return '%s%s%s' % (value, ':', legacySignature(value))
+
+
+def legacyUnsign(signed_value, max_age):
+    value, sig = signed_value.rsplit(crypto.sep, 1)
+    if legacySignature(value) != sig:
+        raise Exception('Signatures do not match')
+    value2, timestamp = value.rsplit(crypto.sep, 1)
+    if time.time() - int(baseconv.base62.decode(timestamp)) > max_age:
+        raise Exception('Expired')
+    return value2
+
+
+def main():
+    signer = crypto.Signer()
+    session = {'userId': 1234567, 'accountId': 89012, 'csrf': 'd41d8cd98f00b204e9800998ecf8427e', 'tz': 'US/Pacific'}
+    value = '.eJyrVkpUsjKsBQAIKgIJ'
+    signed = signer.dict2signed(session, codec='zlib')
+    assert legacyDict2signed(session) == signed and legacyUnsign(signed, 60) == signer.unsign(signed, 60)
+
+    report('signature', rate(lambda: legacySignature(value)), rate(lambda: signer.signature(value)))
+    report('dict2signed', rate(lambda: legacyDict2signed(session)), rate(lambda: signer.dict2signed(session)))
+    report('unsign', rate(lambda: legacyUnsign(signed, 60)), rate(lambda: signer.unsign(signed, 60)))
+    report('crypto.unsign (module, via getSigner)', rate(lambda: legacyUnsign(signed, 60)),
+        rate(lambda: crypto.unsign(signed, 60)))
+
+    cached = crypto.Signer(cache=crypto.VerifiedCache())
+    report('signed2dict (uncached -> VerifiedCache hit)', rate(lambda: signer.signed2dict(signed, 60)),
+        rate(lambda: cached.signed2dict(signed, 60)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""Per-request overhead of the csrf before_request hook, against the original two-hook implementation."""
+
+import flask
+from .. import csrf
+from . import rate, report
+
+viewCount = 200
+
+# Headers of a typical browser request, so the legacy header scan has something to filter.
+browserHeaders = {
+    'Accept': 'application/json, text/javascript, */*; q=0.01',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Accept-Language': 'en-US,en;q=0.9',
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'Origin': 'https://app.example.com',
+    'Pragma': 'no-cache',
+    'Referer': 'https://app.example.com/contacts',
+    'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_5) AppleWebKit/537.36 (KHTML, like Gecko)',
+    'X-Requested-With': 'XMLHttpRequest',
+}
+
+
+def legacyCsrf(app, exemptViews):
+    """The original hooks: a linear exemption scan on every request and two filtered header scans per POST."""
+    csrfTokenKey = app.config.get('CSRF_TOKEN', 'CSRF-TOKEN')
+    request, g = flask.request, flask.g
+
+    def searchCsrfInHeaders():
+        maybeHeader = filter(
+            lambda tup: tup[0].lower() in (csrfTokenKey.lower(), 'x-{0}'.format(csrfTokenKey.lower())),
+            request.headers
+        )
+        return maybeHeader[0][1] if maybeHeader and len(maybeHeader[0]) > 1 else None
+
+    @app.before_request
+    def _csrfCheckExemptions():
+        dest = app.view_functions.get(request.endpoint)
+        g._csrfExempt = dest in exemptViews
+
+    @app.before_request
+    def _csrfProtect():
+        if app.config.get('TESTING'):
+            return
+        if not g._csrfExempt:
+            if request.method in ('POST', 'PUT', 'PATCH', 'DELETE'):
+                csrfToken = request.cookies.get(csrfTokenKey, None)
+                if (not csrfToken and not searchCsrfInHeaders()) or \
+                    (csrfToken != searchCsrfInHeaders() and csrfToken != request.form.get(csrfTokenKey, None)):
+                    flask.abort(400)
+
+
+def newApp(install):
+    app = flask.Flask('flashk_util.benchmarks.csrf')
+    app.config['CSRF_TOKEN'] = 'CSRF-TOKEN'
+    exemptViews = []
+    for i in xrange(viewCount):
+        view = lambda: ''
+        view.__name__ = 'view{0}'.format(i)
+        app.add_url_rule('/view{0}'.format(i), view.__name__, view, methods=['GET', 'POST'])
+        if i % 2:
+            exemptViews.append(view)
+    install(app, exemptViews)
+    return app
+
+
+def installCurrent(app, exemptViews):
+    for view in exemptViews:
+        csrf.csrfExempt(view)
+    csrf.csrf(app)
+
+
+def main():
+    token = 'd41d8cd98f00b204e9800998ecf8427e'
+    headers = dict(browserHeaders, **{'X-CSRF-TOKEN': token})
+    environ = {'HTTP_COOKIE': 'CSRF-TOKEN={0}'.format(token)}
+    apps = newApp(legacyCsrf), newApp(installCurrent)
+
+    for label, method, path in [('GET', 'GET', '/view0'), ('POST', 'POST', '/view0'),
+            ('POST, exempt view', 'POST', '/view199')]:
+        rates = []
+        for app in apps:
+            with app.test_request_context(path, method=method, headers=headers, environ_base=environ):
+                assert app.preprocess_request() is None
+                rates.append(rate(app.preprocess_request, number=20000))
+        report('before_request ({0})'.format(label), *rates)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+"""Throughput of each installed JSON backend against the previous per-call simplejson.dumps, on paginated objects."""
+
+import simplejson
+from sh_util.json import defaultEncoder
+from .. import jsonbackend
+from . import rate, report
+from .suite import sampleObjects
+
+documents = {
+    'error': {'message': '404: Not Found', 'code': 404},
+    'page of 20': {'meta': {'total': 10000, 'limit': 20, 'offset': 100, 'next': None, 'previous': None},
+        'objects': sampleObjects(20)},
+    'page of 1000': {'meta': {'total': 10000, 'limit': 1000, 'offset': 0, 'next': None, 'previous': None},
+        'objects': sampleObjects(1000)},
+}
+
+
+def main():
+    installed = []
+    for name in sorted(jsonbackend._factories, key=lambda name: -jsonbackend._priorities[name]):
+        try:
+            jsonbackend.checkParity(name)
+            installed.append(jsonbackend._factories[name]())
+        except ImportError:
+            print '{0}: not installed'.format(name)
+        except jsonbackend.ParityError as e:
+            print '{0}: {1}'.format(name, e)
+    print 'selected backend: {0}'.format(jsonbackend.backend().name)
+
+    for label, document in sorted(documents.items()):
+        number = max(10, 20000 // len(simplejson.dumps(document, default=defaultEncoder)) * 10)
+        print '{0}, {1} calls per run'.format(label, number)
+        before = rate(lambda: simplejson.dumps(document, default=defaultEncoder), number=number)
+        beforePretty = rate(lambda: simplejson.dumps(document, indent=4, default=defaultEncoder), number=number)
+        for backend in installed:
+            report('  {0:<12} compact'.format(backend.name), before, rate(lambda: backend.compact(document), number))
+            report('  {0:<12} pretty'.format(backend.name), beforePretty,
+                rate(lambda: backend.pretty(document), number))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+"""
+Load test of the serving module against a local Flask app, reporting requests per second and latency percentiles.
+
+    python -m flashk_util.benchmarks.loadtest --clients 32 --duration 10
+    python -m flashk_util.benchmarks.loadtest --server threaded --no-keepalive
+
+`pool` is `serving.ShThreadPoolServer`; `threaded` is werkzeug's thread-per-connection server with the same
+`ShRequestHandler`, for comparison.
+"""
+
+import argparse, httplib, logging, threading, time
+from werkzeug.serving import ThreadedWSGIServer
+from .. import serving
+from .suite import sampleObjects
+
+
+def newApp():
+    import flask
+    from .. import helpers, request
+
+    app = flask.Flask('flashk_util.benchmarks.loadtest')
+    objects = sampleObjects(20)
+
+    @app.route('/contacts')
+    def contacts():
+        return helpers.jsonify(**request.paginate(flask.request, objects, 10000, 0, 20))
+
+    return app
+
+
+def newServer(kind, app, workers):
+    if kind == 'pool':
+        return serving.ShThreadPoolServer('127.0.0.1', 0, app, workers=workers)
+    return ThreadedWSGIServer('127.0.0.1', 0, app, handler=serving.ShRequestHandler)
+
+
+def client(port, path, keepAlive, deadline, latencies, errors):
+    connection = None
+    while True:
+        started = time.time()
+        if started >= deadline:
+            break
+        try:
+            if connection is None:
+                connection = httplib.HTTPConnection('127.0.0.1', port, timeout=10)
+            connection.request('GET', path, headers={} if keepAlive else {'Connection': 'close'})
+            response = connection.getresponse()
+            response.read()
+            if response.status != 200:
+                errors.append(response.status)
+            if not keepAlive or response.getheader('connection', '').lower() == 'close':
+                connection.close()
+                connection = None
+        except Exception as e:
+            errors.append(e)
+            connection = None
+            continue
+        latencies.append(time.time() - started)
+    if connection is not None:
+        connection.close()
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(kind='pool', clients=16, duration=5.0, workers=16, keepAlive=True, path='/contacts'):
+    """Returns `(requests per second, sorted latencies, errors)` for `clients` concurrent clients."""
+    server = newServer(kind, newApp(), workers)
+    serverThread = threading.Thread(target=server.serve_forever)
+    serverThread.daemon = True
+    serverThread.start()
+
+    latencies, errors = [], []
+    deadline = time.time() + duration
+    threads = [threading.Thread(target=client, args=(server.port, path, keepAlive, deadline, latencies, errors))
+        for i in xrange(clients)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - started
+
+    server.shutdown()
+    serverThread.join()
+    return len(latencies) / elapsed, sorted(latencies), errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--server', choices=['pool', 'threaded', 'both'], default='both')
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=16, help='worker threads of the pool server')
+    parser.add_argument('--duration', type=float, default=5.0, help='seconds per run')
+    parser.add_argument('--no-keepalive', dest='keepAlive', action='store_false')
+    args = parser.parse_args(argv)
+
+    # Keep the per-request log line from dominating the measurement.
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    for kind in (['pool', 'threaded'] if args.server == 'both' else [args.server]):
+        rps, latencies, errors = run(kind, args.clients, args.duration, args.workers, args.keepAlive)
+        if not latencies:
+            print '{0:<10} no successful requests, {1} errors'.format(kind, len(errors))
+            continue
+        print '{0:<10} {1:>8,.0f} req/s  p50 {2:>7.2f}ms  p99 {3:>7.2f}ms  max {4:>7.2f}ms  {5} errors'.format(
+            kind, rps, percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, latencies[-1] * 1000,
+            len(errors))
+
+
+if __name__ == '__main__':
+    main()
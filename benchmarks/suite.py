@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+"""
+Regression suite covering every flashk_util hot path.
+
+Each case is a generator taking the Flask test app: it sets up (entering any request context it needs), yields the
+callable to time, and cleans up when resumed.  Rates are reported in `units` per second, e.g. rows for CSV output.
+"""
+
+import json, logging, platform, time
+
+cases = []
+
+
+def case(name, units=1):
+    """Registers a benchmark case."""
+    def decorator(f):
+        cases.append((name, units, f))
+        return f
+    return decorator
+
+
+def newApp():
+    import flask
+    from .. import csrf
+
+    app = flask.Flask('flashk_util.benchmarks')
+    app.config['CSRF_TOKEN'] = 'CSRF-TOKEN'
+    csrf.csrf(app)
+
+    @app.route('/contacts', methods=['GET', 'POST'])
+    def contacts():
+        return ''
+
+    return app
+
+
+def sampleObjects(count):
+    return [{'id': i, 'name': u'Contact {0}'.format(i), 'number': '+1415555{0:04d}'.format(i % 10000),
+        'groups': [1, 2, 3], 'optOut': i % 7 == 0} for i in xrange(count)]
+
+
+@case('crypto.dict2signed')
+def cryptoDict2signed(app):
+    from .. import crypto
+    session = {'userId': 1234567, 'accountId': 89012, 'csrf': 'd41d8cd98f00b204e9800998ecf8427e'}
+    yield lambda: crypto.dict2signed(session)
+
+
+@case('crypto.unsign')
+def cryptoUnsign(app):
+    from .. import crypto
+    signed = crypto.dict2signed({'userId': 1234567, 'accountId': 89012, 'csrf': 'd41d8cd98f00b204e9800998ecf8427e'})
+    yield lambda: crypto.loadEncodedS(crypto.unsign(signed, 60))
+
+
+@case('baseconv.base62.encode')
+def baseconvEncode(app):
+    from .. import baseconv
+    value = int(time.time())
+    yield lambda: baseconv.base62.encode(value)
+
+
+@case('baseconv.base62.decode')
+def baseconvDecode(app):
+    from .. import baseconv
+    encoded = baseconv.base62.encode(int(time.time()))
+    yield lambda: baseconv.base62.decode(encoded)
+
+
+@case('authdigest.DigestAuthentication.verify')
+def digestVerify(app):
+    from .. import authdigest
+    from .authdigest import authorizationFor
+    alg = authdigest.DigestAuthentication('md5')
+    authorization, hA1 = authorizationFor(alg, 'admin', 'bench', 'secret', authdigest.NonceEngine('bench').newNonce())
+    yield lambda: alg.verify(authorization, hA1, 'GET')
+
+
+@case('helpers.csvify (rows)', units=1000)
+def csvify(app):
+    from .. import helpers
+    rows = sampleObjects(1000)
+    headers = ['id', 'name', 'number', 'groups', 'optOut']
+    with app.test_request_context('/contacts.csv'):
+        yield lambda: ''.join(helpers.csvify(headers=headers, rows=rows).response)
+
+
+@case('helpers.jsonify (objects)', units=100)
+def jsonify(app):
+    from .. import helpers, request
+    objects = sampleObjects(100)
+    with app.test_request_context('/contacts?offset=100&limit=100') as ctx:
+        yield lambda: helpers.jsonify(**request.paginate(ctx.request, objects, 10000, 100, 100)).data
+
+
+@case('helpers.jsonifyStream (objects)', units=100)
+def jsonifyStream(app):
+    from .. import helpers, request
+    objects = sampleObjects(100)
+    with app.test_request_context('/contacts?offset=100&limit=100') as ctx:
+        yield lambda: ''.join(helpers.jsonifyStream(**request.paginate(ctx.request, objects, 10000, 100, 100)).response)
+
+
+@case('request.paginate')
+def paginate(app):
+    from .. import request
+    objects = sampleObjects(20)
+    with app.test_request_context('/contacts?offset=100&limit=20') as ctx:
+        yield lambda: request.paginate(ctx.request, objects, 10000, 100, 20)
+
+
+@case('metrics.LatencyHistograms.record')
+def metricsRecord(app):
+    from .. import metrics
+    histograms = metrics.LatencyHistograms()
+    yield lambda: histograms.record('contacts', 200, 0.0123)
+
+
+@case('log_formatter.ShLoggingFormatter.format')
+def logFormat(app):
+    from ..log_formatter import ShLoggingFormatter
+    from ..log_request_id import RequestIDFilter
+    from ..log_task_id import TaskIDFilter
+
+    handler = logging.NullHandler()
+    handler.addFilter(RequestIDFilter())
+    handler.addFilter(TaskIDFilter())
+    formatter = ShLoggingFormatter('%(asctime)s %(levelname)s %(name)s: %(message)s')
+    record = logging.LogRecord('bench', logging.INFO, __file__, 1, 'Sent %d messages', (3,), None)
+
+    with app.test_request_context('/contacts', headers={'X-Request-Id': 'c0ffee00-0000-4000-8000-000000000000'}):
+        yield lambda: handler.filter(record) and formatter.format(record)
+
+
+@case('csrf before_request (GET)')
+def csrfGet(app):
+    with app.test_request_context('/contacts'):
+        yield app.preprocess_request
+
+
+@case('csrf before_request (POST)')
+def csrfPost(app):
+    token = 'd41d8cd98f00b204e9800998ecf8427e'
+    environ = {'HTTP_COOKIE': 'CSRF-TOKEN={0}'.format(token)}
+    with app.test_request_context('/contacts', method='POST', headers={'X-CSRF-TOKEN': token}, environ_base=environ):
+        yield app.preprocess_request
+
+
+def selected(name, only):
+    return not only or any(pattern in name for pattern in only)
+
+
+def run(only=None, minTime=0.2):
+    """Runs the suite and returns {case name: units per second}; cases that cannot be imported are skipped."""
+    from . import autorate, report
+
+    app = newApp()
+    results = {}
+    for name, units, f in cases:
+        if not selected(name, only):
+            continue
+        steps = f(app)
+        try:
+            func = next(steps)
+        except ImportError as e:
+            print '{0:<48} skipped ({1})'.format(name, e)
+            continue
+        try:
+            results[name] = autorate(func, minTime) * units
+        finally:
+            steps.close()
+        report(name, results[name])
+    return results
+
+
+def save(path, results):
+    with open(path, 'w') as f:
+        json.dump({
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'created': int(time.time()),
+            'results': results,
+        }, f, indent=2, sort_keys=True)
+
+
+def compare(path, results, threshold, only=None):
+    """
+    Prints the change against a saved baseline and returns `(regressions, missing)`: the names of cases slower by more
+    than `threshold`, and of selected baseline cases that produced no result, e.g. renamed or skipped on ImportError.
+    """
+    with open(path) as f:
+        baseline = json.load(f)['results']
+
+    regressions, missing = [], []
+    for name in sorted(set(results) | set(baseline)):
+        if name not in baseline:
+            print '{0:<48} {1:>8}'.format(name, 'new')
+            continue
+        if name not in results:
+            if selected(name, only):
+                print '{0:<48} {1:>8}  MISSING'.format(name, '-')
+                missing.append(name)
+            continue
+        change = results[name] / baseline[name] - 1
+        regressed = change < -threshold
+        print '{0:<48} {1:>+8.1%}{2}'.format(name, change, '  REGRESSION' if regressed else '')
+        if regressed:
+            regressions.append(name)
+    return regressions, missing
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m flashk_util.benchmarks',
+        description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--save', metavar='PATH', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='PATH', help='compare the results against a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.2,
+        help='fractional slowdown against the baseline that fails the run (default: 0.2)')
+    parser.add_argument('--min-time', type=float, default=0.2, help='minimum seconds per timing run (default: 0.2)')
+    parser.add_argument('only', nargs='*', help='only run cases whose name contains one of these strings')
+    args = parser.parse_args(argv)
+
+    results = run(args.only, args.min_time)
+    if args.save:
+        save(args.save, results)
+    if args.compare:
+        print
+        regressions, missing = compare(args.compare, results, args.threshold, args.only)
+        if regressions:
+            print '\n{0} case(s) regressed by more than {1:.0%}'.format(len(regressions), args.threshold)
+        if missing:
+            print '\n{0} baseline case(s) did not run: {1}'.format(len(missing), ', '.join(missing))
+        if regressions or missing:
+            return 1
+    return 0
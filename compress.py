@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+
+"""
+A small Flask module for compressing responses with gzip or deflate.
+
+    from flashk_util.compress import compress
+    compress(app)
+
+Responses are compressed when the client's Accept-Encoding allows it, their mimetype is in the allowlist and their
+body is at least the minimum size.  Buffered bodies are compressed in one go; streamed bodies are compressed chunk by
+chunk as they are sent, after peeking at up to the minimum size of their first chunks.  Responses that are already
+encoded, partial (206), served with Accept-Ranges or marked Cache-Control: no-transform are left alone.
+
+Configuration, with defaults:
+
+    COMPRESS_MIMETYPES   JSON, JavaScript, CSV, HTML, CSS, XML and plain text
+    COMPRESS_ALGORITHMS  ['gzip', 'deflate'], in order of preference when the client accepts several equally
+    COMPRESS_LEVEL       6
+    COMPRESS_MIN_SIZE    500 bytes
+"""
+
+import itertools, zlib
+from flask import request
+
+defaultMimetypes = [
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'text/csv',
+    'text/css',
+    'text/html',
+    'text/javascript',
+    'text/plain',
+    'text/xml',
+]
+
+# zlib window bits producing each content coding: a gzip wrapper, or the zlib wrapper that HTTP calls "deflate".
+_windowBits = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+# Statuses that have no body to compress or whose body is a byte range of an uncompressed representation.
+_skipStatuses = frozenset([204, 206, 304])
+
+
+def compressChunks(chunks, encoding='gzip', level=6):
+    """Compresses an iterable of byte strings incrementally with `encoding`, yielding compressed chunks."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _windowBits[encoding])
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compressBytes(data, encoding='gzip', level=6):
+    """Compresses a byte string with `encoding`."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, _windowBits[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+
+def _peek(chunks, size):
+    """Reads chunks until `size` bytes are seen, returning them and whether the iterable was exhausted."""
+    head, seen = [], 0
+    for chunk in chunks:
+        head.append(chunk)
+        seen += len(chunk)
+        if seen >= size:
+            return head, False
+    return head, True
+
+
+def compress(app):
+    mimetypes = frozenset(app.config.get('COMPRESS_MIMETYPES', defaultMimetypes))
+    algorithms = [a for a in app.config.get('COMPRESS_ALGORITHMS', ['gzip', 'deflate']) if a in _windowBits]
+    level = app.config.get('COMPRESS_LEVEL', 6)
+    minSize = app.config.get('COMPRESS_MIN_SIZE', 500)
+
+    def chooseEncoding():
+        best, bestQuality = None, 0
+        for algorithm in algorithms:
+            quality = request.accept_encodings[algorithm]
+            if quality > bestQuality:
+                best, bestQuality = algorithm, quality
+        return best
+
+    @app.after_request
+    def _compressResponse(response):
+        if response.mimetype not in mimetypes or response.status_code < 200 or \
+                response.status_code in _skipStatuses or request.method == 'HEAD':
+            return response
+
+        headers = response.headers
+        if 'Content-Encoding' in headers or headers.get('Accept-Ranges', 'none') != 'none' or \
+                'no-transform' in headers.get('Cache-Control', ''):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = chooseEncoding()
+        if encoding is None or response.direct_passthrough:
+            return response
+
+        if response.is_streamed:
+            original = response.response
+            chunks = response.iter_encoded()
+            head, exhausted = _peek(chunks, minSize)
+            if exhausted:
+                response.set_data(''.join(head))
+                if hasattr(original, 'close'):
+                    original.close()
+                return response
+            response.response = compressChunks(itertools.chain(head, chunks), encoding, level)
+            if hasattr(original, 'close'):
+                response.call_on_close(original.close)
+            headers.pop('Content-Length', None)
+        else:
+            if response.content_length < minSize:
+                return response
+            response.set_data(compressBytes(response.get_data(), encoding, level))
+
+        headers['Content-Encoding'] = encoding
+        # The compressed body is a different representation of the same resource: keep the ETag, but weak.
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
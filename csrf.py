@@ -10,60 +10,119 @@ NB: Based on http://sjl.bitbucket.org/flask-csrf/ with subsequent modifications
 
 To allow custom CSRF header to be used in place of cookie or form post, set app.conf['CSRF_TOKEN'] to the header/cookie
 name you want to use.
+
+Set app.config['CSRF_SIGNED'] to issue stateless signed tokens instead of random ones: the token carries a timestamp and
+a hash of the session it was issued to (see the `sessionBinding` argument of `csrf`), and is signed with a
+`crypto.Signer`.  Requests are checked without server side state, tokens expire after CSRF_TOKEN_LIFETIME seconds, and
+the cookie is only re-issued when less than CSRF_TOKEN_REFRESH seconds of its lifetime remain, rather than on every
+rendered page.
+
+Views and whole blueprints are exempted with `csrfExempt`.  Exempt views are resolved to their endpoint names when the
+app serves its first request, once its views are registered, and again whenever more views are exempted, so checking an
+exemption is a set lookup.  `g._csrfExempt` is set on every request.
 """
 
-import logging
+import hashlib, logging, settings, time
 from uuid import uuid4
-from flask import abort, request, g
-from werkzeug.routing import NotFound
+from flask import abort, request, g, Blueprint
+from . import crypto
 
-_exemptViews = []
+_exemptViews = set()
+_exemptBlueprints = set()
+
+# Methods that are checked; every other method returns before any work is done.
+_protectedMethods = frozenset(['POST', 'PUT', 'PATCH', 'DELETE'])
 
 
 def csrfExempt(view):
-    _exemptViews.append(view)
+    """Exempts a view function, or every view of a `Blueprint`, from CSRF protection."""
+    if isinstance(view, Blueprint):
+        _exemptBlueprints.add(view.name)
+    else:
+        _exemptViews.add(view)
     return view
 
 
-def csrf(app, onCsrf=None):
+def csrf(app, onCsrf=None, sessionBinding=None):
+    """
+    Installs CSRF protection on `app`.
+
+    :param onCsrf: optional callable invoked before a failed check aborts the request.
+    :param sessionBinding: optional callable returning a string identifying the current session or user, e.g. the
+        session id.  Signed tokens are only accepted from the session they were issued to.
+    """
     csrfTokenKey = app.config.get('CSRF_TOKEN', 'CSRF-TOKEN')
     csrfTokenDomain = app.config.get('CSRF_TOKEN_DOMAIN', None)
+    signed = app.config.get('CSRF_SIGNED', False)
+    lifetime = app.config.get('CSRF_TOKEN_LIFETIME', 24 * 3600)
+    refresh = app.config.get('CSRF_TOKEN_REFRESH', lifetime // 4)
+    signer = crypto.Signer(salt=settings.SALT + 'csrf', keys=getattr(settings, 'SECRET_KEYS', None)) if signed else None
 
-    def searchCsrfInHeaders():
-        """Searches through a set of key-value pairs for a CSRF token."""
-        maybeHeader = filter(
-            lambda tup: tup[0].lower() in (csrfTokenKey.lower(), 'x-{0}'.format(csrfTokenKey.lower())),
-            request.headers
-        )
-        return maybeHeader[0][1] if maybeHeader and len(maybeHeader[0]) > 1 else None
+    # WSGI environ keys of the `<csrfTokenKey>` and `X-<csrfTokenKey>` request headers.
+    headerKey = 'HTTP_{0}'.format(csrfTokenKey.upper().replace('-', '_'))
+    xHeaderKey = 'HTTP_X_{0}'.format(csrfTokenKey.upper().replace('-', '_'))
 
-    @app.before_request
-    def _csrfCheckExemptions():
+    def bindingHash():
+        binding = sessionBinding() if sessionBinding is not None else None
+        return hashlib.sha1(binding.encode('utf-8') if isinstance(binding, unicode) else binding or '').hexdigest()[:16]
+
+    def newSignedToken():
+        return signer.sign('{0}.{1}'.format(uuid4().hex, bindingHash()))
+
+    def signedTokenAge(token):
+        """Returns the age in seconds of a valid signed token issued to this session, otherwise None."""
         try:
-            dest = app.view_functions.get(request.endpoint)
-            g._csrfExempt = dest in _exemptViews
-        except NotFound:
-            g._csrfExempt = False
-    
+            value, timestamp = signer.verify(token)
+        except crypto.BadSignature:
+            return None
+        age = time.time() - timestamp
+        if age > lifetime or value.rpartition('.')[2] != bindingHash():
+            return None
+        return age
+
+    # Exempt endpoint names, with the number of exempt views they were compiled from.
+    compiled = {'endpoints': frozenset(), 'exemptViews': None}
+
+    @app.before_first_request
+    def _csrfCompileExemptions():
+        compiled['endpoints'] = frozenset(
+            endpoint for endpoint, view in app.view_functions.iteritems() if view in _exemptViews)
+        compiled['exemptViews'] = len(_exemptViews)
+
+    def exemptEndpoints():
+        # Also compiles for requests that skip before_first_request, e.g. `app.preprocess_request` in tests.
+        if compiled['exemptViews'] != len(_exemptViews):
+            _csrfCompileExemptions()
+        return compiled['endpoints']
+
     @app.before_request
     def _csrfProtect():
+        # Set whatever the method: views read it on safe requests too.
+        g._csrfExempt = exempt = request.endpoint in exemptEndpoints() or \
+            bool(_exemptBlueprints) and request.blueprint in _exemptBlueprints
+        if request.method not in _protectedMethods:
+            return
+
         # This simplifies unit testing, wherein CSRF seems to break.
         if app.config.get('TESTING'):
             return
 
-        if not g._csrfExempt:
-            # NB: Don't enforce CSRF if there was no referer.  This frees API clients from worrying about it but
-            # enforces it for browser clients.
-            if request.method in ('POST', 'PUT', 'PATCH', 'DELETE'):
-                csrfToken = request.cookies.get(csrfTokenKey, None)
-                if (not csrfToken and not searchCsrfInHeaders()) or \
-                    (csrfToken != searchCsrfInHeaders() and csrfToken != request.form.get(csrfTokenKey, None)):
-                    if onCsrf and callable(onCsrf):
-                        logging.debug(u'Invoking custom CSRF failure handler')
-                        onCsrf(*app.match_request())
+        if exempt:
+            return
 
-                    logging.error(u'CSRF verification failed, aborting request')
-                    abort(400)
+        # NB: Don't enforce CSRF if there was no referer.  This frees API clients from worrying about it but
+        # enforces it for browser clients.
+        csrfToken = request.cookies.get(csrfTokenKey, None)
+        headerToken = request.environ.get(headerKey) or request.environ.get(xHeaderKey)
+        if (not csrfToken and not headerToken) or \
+            (csrfToken != headerToken and csrfToken != request.form.get(csrfTokenKey, None)) or \
+            (signed and csrfToken and signedTokenAge(csrfToken) is None):
+            if onCsrf and callable(onCsrf):
+                logging.debug(u'Invoking custom CSRF failure handler')
+                onCsrf(*app.match_request())
+
+            logging.error(u'CSRF verification failed, aborting request')
+            abort(400)
 
     @app.after_request
     def _setCsrfCookie(response):
@@ -72,6 +131,8 @@ def csrf(app, onCsrf=None):
             csrfToken = getattr(request, csrfTokenKey)
             logging.debug(u'Setting CSRF token in response cookie: {0}:{1}'.format(csrfTokenKey, csrfToken))
             maybeCsrfDomain = {'domain': csrfTokenDomain} if csrfTokenDomain is not None else {}
+            if signed:
+                maybeCsrfDomain['max_age'] = lifetime
             response.set_cookie(csrfTokenKey, csrfToken, **maybeCsrfDomain)
         return response
     
@@ -82,6 +143,27 @@ def csrf(app, onCsrf=None):
             setattr(request, csrfTokenKey, csrfToken)
             logging.debug(u'Generated a new CSRF token: {0}'.format(csrfToken))
         return getattr(request, csrfTokenKey)
+
+    def generateSignedCsrfToken():
+        """Returns the cookie's signed token while it is fresh, otherwise issues a new one to be set as the cookie."""
+        if hasattr(request, csrfTokenKey):
+            return getattr(request, csrfTokenKey)
+        if getattr(g, '_csrfToken', None):
+            return g._csrfToken
+
+        csrfToken = request.cookies.get(csrfTokenKey, None)
+        age = signedTokenAge(csrfToken) if csrfToken else None
+        if age is not None and age < lifetime - refresh:
+            g._csrfToken = csrfToken
+            return csrfToken
+
+        csrfToken = newSignedToken()
+        setattr(request, csrfTokenKey, csrfToken)
+        logging.debug(u'Generated a new signed CSRF token: {0}'.format(csrfToken))
+        return csrfToken
+
+    if signed:
+        generateCsrfToken = generateSignedCsrfToken
     
     app.jinja_env.globals['csrfToken'] = generateCsrfToken
 
@@ -2,11 +2,15 @@
 
 """Flask utilities and generalized helper functionality."""
 
-import settings, simplejson as json, unicodedata
-from flask import request
+import collections, csv, cStringIO, hashlib, itertools, operator, re, settings, tempfile, unicodedata
+from functools import wraps
+from flask import request, stream_with_context
 from flask.globals import current_app
 from werkzeug.datastructures import Headers
-from sh_util.json import defaultEncoder
+from werkzeug.wsgi import wrap_file
+from . import jsonbackend
+from .compress import compressChunks
+from .request import decodeCursor
 
 def jsonify(*args, **kwargs):
     """Creates a :class:`~flask.Response` with the JSON representation of
@@ -29,20 +33,98 @@ def jsonify(*args, **kwargs):
             "id": 42
         }
 
-    This requires Python 2.6 or an installed version of simplejson.  For
-    security reasons only objects are supported toplevel.  For more
-    information about this, have a look at :ref:`json-security`.
+    The output is compact, without spaces after separators, for XHR
+    requests and indented otherwise.  It is encoded by the highest
+    priority installed :mod:`jsonbackend`: simplejson, else the standard
+    library `json`.  For security reasons only objects are supported
+    toplevel.  For more information about this, have a look at
+    :ref:`json-security`.
 
     .. versionadded:: 0.2
     """
     status_code = kwargs.pop('status_code', None)
 
     response = current_app.response_class(
-        json.dumps(
-            dict(*args, **kwargs),
-            indent=None if request.is_xhr else 4,
-            default=defaultEncoder
-        ),
+        jsonbackend.dumps(dict(*args, **kwargs), pretty=not request.is_xhr),
+        mimetype='application/json'
+    )
+
+    if status_code is not None:
+        response.status_code = status_code
+
+    return response
+
+
+# Approximate size of each chunk yielded by `generateJsonChunks`, and the number of elements encoded per call.
+jsonChunkSize = 64 * 1024
+_jsonBatchItems = 256
+
+# Top level values streamed element by element (lists, tuples, generators and other iterators).
+_jsonStreamTypes = (list, tuple, collections.Iterator)
+
+
+def generateJsonChunks(data, pretty=False, chunkSize=None):
+    """
+    Yields the JSON document for the dict `data` in chunks of roughly `chunkSize` bytes.
+
+    List, tuple and iterator values of `data`, such as the `objects` of a `request.paginate` result, are encoded a
+    batch of elements at a time so the full document is never held in memory.  Output uses compact separators, or
+    matches the pretty output of :mod:`jsonbackend` when `pretty` is set.
+    """
+    chunkSize = chunkSize or jsonChunkSize
+    if pretty:
+        encode = jsonbackend.backend().pretty
+        keySep, indent = ': ', '\n    '
+    else:
+        encode = jsonbackend.backend().compact
+        keySep, indent = ':', ''
+
+    parts, size = ['{'], 1
+    for i, (key, value) in enumerate(data.iteritems()):
+        parts.append('{0}{1}{2}{3}'.format(',' if i else '', indent, encode(key), keySep))
+        # Namedtuples are written as objects, so they are encoded whole like any other value.
+        if not isinstance(value, _jsonStreamTypes) or hasattr(value, '_asdict'):
+            value = encode(value)
+            parts.append(value.replace('\n', indent) if pretty else value)
+            size += len(parts[-1])
+            continue
+
+        # Elements are encoded a batch at a time as a list, whose brackets (and closing indent) are then cut off.
+        parts.append('[')
+        value = iter(value)
+        empty = True
+        while True:
+            batch = list(itertools.islice(value, _jsonBatchItems))
+            if not batch:
+                break
+            batch = encode(batch)
+            if pretty:
+                batch = batch.replace('\n', indent)
+            batch = batch[1:-1 - len(indent)]
+            parts.append(batch if empty else ',' + batch)
+            size += len(parts[-1])
+            empty = False
+            if size >= chunkSize:
+                yield ''.join(parts)
+                parts, size = [], 0
+        parts.append(']' if empty else indent + ']')
+
+    parts.append('}' if not data else indent[:1] + '}')
+    yield ''.join(parts)
+
+
+def jsonifyStream(*args, **kwargs):
+    """
+    Streaming variant of :func:`jsonify` for large responses, e.g. ``jsonifyStream(**request.paginate(...))``.
+
+    The body is produced by `generateJsonChunks` while `objects` (or any other list or iterator value) is iterated,
+    using compact separators unless `pretty=True` is passed.
+    """
+    status_code = kwargs.pop('status_code', None)
+    pretty = kwargs.pop('pretty', False)
+
+    response = current_app.response_class(
+        stream_with_context(generateJsonChunks(dict(*args, **kwargs), pretty)),
         mimetype='application/json'
     )
 
@@ -53,10 +135,16 @@ def jsonify(*args, **kwargs):
 
 
 def getViewWindowParams(*params):
-    """Convenience method to access `offset`, `limit`, `sort`, and `order` request result set specifiers."""
+    """
+    Convenience method to access `offset`, `limit`, `sort`, `order` and `cursor` request result set specifiers.
+
+    `cursor` is None when the request has none, otherwise the verified `request.Cursor` made by `request.paginate`;
+    forged, expired or malformed cursors raise `request.BadRequest`.
+    """
     out = []
     for param in params:
-        assert param in ('offset', 'limit', 'sort', 'order'), 'Requested parameter "{0}" is not available'.format(param)
+        assert param in ('offset', 'limit', 'sort', 'order', 'cursor'), \
+            'Requested parameter "{0}" is not available'.format(param)
 
         if param == 'offset':
             value = int(request.args.get(param) if param in request.args and request.args[param].isdigit() else 0)
@@ -71,25 +159,132 @@ def getViewWindowParams(*params):
         elif param == 'order':
             value = request.args.get(param) if param in request.args else 'desc'
 
+        elif param == 'cursor':
+            value = decodeCursor(request, request.args[param]) if request.args.get(param) else None
+
         out.append(value)
 
     return out
 
 
-def _escapeQuotes(key, _dict):
+_nonAsciiRe = re.compile(r'[^\x00-\x7f]')
+
+# Approximate size of each chunk yielded by the CSV engine, and the number of rows written between size checks.
+csvChunkSize = 64 * 1024
+_csvBatchRows = 256
+_csvNumbers = frozenset([int, long, float, bool])
+
+
+def _csvValue(value):
+    """Converts a value to the byte string written for it, for anything but a plain NUL-free `str`."""
+    if value is None:
+        return ''
+    elif type(value) in _csvNumbers:
+        return str(value)
+    elif isinstance(value, unicode):
+        try:
+            value = value.encode('ascii')
+        except UnicodeEncodeError:
+            value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore')
+    elif not isinstance(value, str):
+        value = str(value)
+    # The csv module stops writing a field at the first NUL.
+    return value.replace('\0', '')
+
+
+def _csvExtractor(headers):
+    """Returns a function mapping a dict, tuple or list row to its list of values in `headers` order."""
+    count = len(headers)
+    getter = operator.itemgetter(*headers)
+    padding = [''] * count
+
+    def extract(row):
+        if isinstance(row, (tuple, list)):
+            values = list(row[:count])
+            if len(values) < count:
+                values.extend(padding[len(values):])
+            return values
+        try:
+            values = getter(row)
+        except (KeyError, TypeError):
+            return [row.get(header, '') for header in headers]
+        return [values] if count == 1 else values
+
+    return extract
+
+
+def _csvAscii(chunk):
+    """Reduces non-ASCII text to ASCII the way csvify always has: NFKD normalization, then dropping what's left."""
+    if _nonAsciiRe.search(chunk) is None:
+        return chunk
+    return unicodedata.normalize('NFKD', chunk.decode('utf-8', 'ignore')).encode('ascii', 'ignore')
+
+
+def generateCsvChunks(headers, rows, chunkSize=None):
     """
-    Safely escape quotes of each item that goes in a row
-    @param key: The key of the dictionary to pull from.
-    @param _dict: The target dictionary holding the data
-    @return:
+    Yields the CSV document for `headers` and `rows` in chunks of roughly `chunkSize` bytes.
+
+    The header line is written unquoted and every value is quoted, with embedded quotes doubled.  Rows may be dicts
+    keyed by header, or tuples/lists in header order.  Missing and None values are written as empty strings and
+    non-ASCII text is NFKD normalized and reduced to ASCII.
     """
-    value = _dict.get(key, '')
-    # if the key exists but has a None value, just use the empty string.
-    value = value if value is not None else ''
-    value = value if isinstance(value, str) else str(value)
-    value = value.replace('"', '""')
-    return value
- 
+    chunkSize = chunkSize or csvChunkSize
+    extract = _csvExtractor(headers)
+    rows = iter(rows)
+
+    buf = cStringIO.StringIO()
+    buf.write('{}\n'.format(','.join(headers)))
+    writer = csv.writer(buf, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    while True:
+        batch = [
+            [v if type(v) is str and '\0' not in v else _csvValue(v) for v in extract(row)]
+            for row in itertools.islice(rows, _csvBatchRows)
+        ]
+        if batch:
+            writer.writerows(batch)
+        if buf.tell() >= chunkSize or not batch:
+            chunk = buf.getvalue()
+            if chunk:
+                yield _csvAscii(chunk)
+            if not batch:
+                return
+            buf = cStringIO.StringIO()
+            writer = csv.writer(buf, quoting=csv.QUOTE_ALL, lineterminator='\n')
+
+# zlib compression level used by `gzipChunks` and compressed CSV exports.
+gzipLevel = 6
+
+
+def acceptsGzip():
+    """True when the current request's Accept-Encoding allows a gzip encoded response."""
+    return request.accept_encodings['gzip'] > 0
+
+
+def gzipChunks(chunks, level=None):
+    """Gzip compresses an iterable of byte strings incrementally, yielding compressed chunks as they fill."""
+    return compressChunks(chunks, 'gzip', gzipLevel if level is None else level)
+
+
+def spoolChunks(chunks):
+    """
+    Writes an iterable of byte strings to an anonymous temporary file.
+
+    :return: a tuple of the file, rewound to its start, its size in bytes and the hex md5 digest of its contents.
+    """
+    spool = tempfile.TemporaryFile()
+    digest = hashlib.md5()
+    size = 0
+    try:
+        for chunk in chunks:
+            spool.write(chunk)
+            digest.update(chunk)
+            size += len(chunk)
+        spool.seek(0)
+    except:
+        spool.close()
+        raise
+    return spool, size, digest.hexdigest()
+
 
 def csvify(*args, **kwargs):
     """
@@ -117,36 +312,117 @@ def csvify(*args, **kwargs):
     This will send a CSV file response like this to the client::
 
         date,message
-        2012-12-12,foo
-        2011-11-11,bar
+        "2012-12-12","foo"
+        "2011-11-11","bar"
+
+    Rows may also be tuples or lists in header order.  The body is streamed in chunks of about 64 KB, see
+    `generateCsvChunks`.
+
+    Pass `compress=True` to gzip the stream incrementally when the client's Accept-Encoding allows it.  Pass
+    `spool=True` to write the export to a temporary file first and serve it with a Content-Length, an ETag and HTTP
+    Range support, so interrupted downloads can resume.  Both options keep memory use constant in the number of rows.
     """
     headers = [str(header) for header in kwargs.pop('headers', [])]
     assert len(headers) > 0, 'Cannot write CSV without Headers!'
     rows = kwargs.pop('rows', [])
 
-    def generateCsv():
-        """Write the header and the iterate over the rows."""
-        ##########################################################################
-        # write the header
-        yield '{}\n'.format(','.join(headers))
-        ##########################################################################
-        # Write the body of the document
-        # ----> First generate the format string reused for each row in the csv
-        #       file such that row_string = '{},{},{},{},...\n'
-        row_string = u'{}\n'.format(u','.join([u'"{}"' for header in headers]))
-        # ---> Then use that format string as the output to the next row
-        for row in rows:
-            # Get a value for each header, making sure to escape quotes and
-            # normalize for unicode along the way
-            csv_line = [_escapeQuotes(header, row) for header in headers]
-            csv_line = row_string.format(*csv_line)
-            yield unicodedata.normalize('NFKD', csv_line).encode('ascii', 'ignore')
-
     filename = kwargs.pop('filename', 'file.csv')
     as_download = kwargs.pop('as_download', False)
-    response_headers = None
+    compress = kwargs.pop('compress', False)
+    spool = kwargs.pop('spool', False)
+    response_headers = Headers()
     if as_download:
-        response_headers = Headers([('Content-Disposition', "attachment;filename={filename}".format(filename=filename))])
+        response_headers.add('Content-Disposition', "attachment;filename={filename}".format(filename=filename))
+
+    body = generateCsvChunks(headers, rows)
+    if compress:
+        response_headers.add('Vary', 'Accept-Encoding')
+        if acceptsGzip():
+            body = gzipChunks(body)
+            response_headers.add('Content-Encoding', 'gzip')
+
+    if not spool:
+        return current_app.response_class(body, mimetype='text/csv', headers=response_headers)
+
+    f, size, etag = spoolChunks(body)
+    response = current_app.response_class(
+        wrap_file(request.environ, f), mimetype='text/csv', headers=response_headers, direct_passthrough=True)
+    response.content_length = size
+    response.set_etag(etag)
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
+def _versionETag(version):
+    """
+    Strong ETag for a view `version` key, distinct per URL and query string and per representation of the body: the
+    same version is served pretty or compact by `jsonify` depending on XHR, and gzipped or not by `csvify`.
+    """
+    representation = '{0}:{1}'.format('xhr' if request.is_xhr else '', 'gzip' if acceptsGzip() else '')
+    return hashlib.md5('{0}\n{1}\n{2}'.format(request.full_path, version, representation)).hexdigest()
+
+
+def conditional(func=None, versionKey=None, spool=False):
+    """
+    Decorator adding a strong ETag and conditional GET support to a view, e.g. one returning `jsonify` or `csvify`.
+
+    The ETag is the md5 of the response body.  A streamed body, e.g. from `jsonifyStream` or `csvify`, is sent as it is
+    generated and gets no ETag unless `spool` is set: it is then written whole to a temporary file (see `spoolChunks`)
+    before its first byte is sent, trading time to first byte for a 304 on the next request.  GET and HEAD requests
+    whose If-None-Match matches get an empty 304.
+
+    `versionKey` is an optional cheap callback taking the view's arguments and returning a value that changes whenever
+    the body would, e.g. a last-modified timestamp.  When it returns anything but None the ETag is derived from it, the
+    URL and the representation the request gets (XHR, gzip), and a matching request is answered with a 304 without
+    calling the view at all::
+
+        @app.route('/contacts')
+        @conditional(versionKey=lambda: contactsVersion(g.user))
+        def contacts():
+            ...
+
+    `versionKey` needs neither the body nor `spool`, so it suits streamed views best.
+    """
+    if func is None:
+        return lambda f: conditional(f, versionKey, spool)
+
+    @wraps(func)
+    def decorated_function(*args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return func(*args, **kwargs)
+
+        etag = None
+        if versionKey is not None:
+            version = versionKey(*args, **kwargs)
+            if version is not None:
+                etag = _versionETag(version)
+                if request.if_none_match.contains_weak(etag):
+                    response = current_app.response_class(status=304)
+                    response.set_etag(etag)
+                    return response
+
+        response = current_app.make_response(func(*args, **kwargs))
+        if response.status_code != 200:
+            return response
 
-    return current_app.response_class(generateCsv(), mimetype='text/csv', headers=response_headers)
+        if etag is not None:
+            response.set_etag(etag)
+        elif response.get_etag()[0] is None:
+            if response.is_streamed:
+                if not spool:
+                    return response
+                chunks = response.response
+                try:
+                    f, size, etag = spoolChunks(chunks)
+                finally:
+                    # Runs the body's own cleanup, e.g. that of stream_with_context, now rather than never.
+                    if hasattr(chunks, 'close'):
+                        chunks.close()
+                # Not a direct passthrough: werkzeug would skip the response's `call_on_close` callbacks.
+                response.response = wrap_file(request.environ, f)
+                response.content_length = size
+            else:
+                etag = hashlib.md5(response.get_data()).hexdigest()
+            response.set_etag(etag)
 
+        return response.make_conditional(request)
+    return decorated_function
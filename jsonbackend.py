@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+"""
+Registry of JSON encoders used by `helpers.jsonify`, `helpers.jsonifyStream`, `response.make_json_error` and
+`request.jsonp`.
+
+Backends are tried in a fixed priority order, not by measured speed: the first registered backend (highest priority)
+that imports and passes `checkParity` is selected on first use.  Only simplejson (priority 100) and the standard
+library `json` module (0, the guaranteed fallback) are registered; no faster encoder has a Python 2 release.  The
+canonical output is simplejson's:
+
+    compact  separators (',', ':'), as `jsonifyStream` has always written
+    pretty   indent=4, separators (',', ': '), as non-XHR `jsonify` has always written
+
+XHR `jsonify` responses and `make_json_error` bodies are compact.  They used to be written with `(', ', ': ')`
+separators and, for `make_json_error`, with Flask's sorted keys and indentation, so their bytes differ from before
+while decoding to the same values.
+
+with ASCII-only output, dict keys in iteration order, Decimals written as numbers with their exact digits (`12.50`),
+namedtuples written as objects and `sh_util.json.defaultEncoder` applied to any other value the encoder does not
+handle natively.  Every other backend must match it byte for byte.
+
+Register another encoder with:
+
+    def ujsonBackend():
+        import ujson
+        return Backend('ujson', lambda o: ujson.dumps(o), lambda o: ujson.dumps(o, indent=4), ujson.loads)
+
+    jsonbackend.registerBackend('ujson', ujsonBackend, priority=200)
+"""
+
+import binascii, collections, datetime, decimal, os, re, threading
+from sh_util.json import defaultEncoder
+
+Backend = collections.namedtuple('Backend', ['name', 'compact', 'pretty', 'loads'])
+
+_factories = {}
+_priorities = {}
+_lock = threading.Lock()
+_current = None
+
+
+class ParityError(ValueError):
+    """Raised when a backend's output differs from the canonical output of the simplejson backend."""
+
+
+def registerBackend(name, factory, priority=0):
+    """
+    Registers a JSON backend.
+
+    :param factory: callable returning a `Backend`; it may raise ImportError when its encoder is not installed.
+    :param priority: backends are tried in descending priority order.
+    """
+    global _current
+    with _lock:
+        _factories[name] = factory
+        _priorities[name] = priority
+        _current = None
+
+
+def _simplejsonBackend():
+    import simplejson
+    options = dict(default=defaultEncoder, use_decimal=True, namedtuple_as_object=True, for_json=False)
+    compact = simplejson.JSONEncoder(separators=(',', ':'), **options).encode
+    pretty = simplejson.JSONEncoder(indent=4, separators=(',', ': '), **options).encode
+    return Backend('simplejson', compact, pretty, simplejson.loads)
+
+
+# The standard library can't write a Decimal as a raw number, so `_simplejsonTypes` swaps each one for a string made of
+# this per-process marker and its digits, and `_stdlibEncoder` unquotes those strings after encoding.
+_decimalMarker = 'decimal-{0}:'.format(binascii.hexlify(os.urandom(8)))
+_decimalMarkerRe = re.compile('"{0}([-+.0-9A-Za-z]+)"'.format(re.escape(_decimalMarker)))
+
+
+def _simplejsonTypes(o):
+    """Rebuilds containers in `o` so the standard library encodes namedtuples and Decimals like simplejson."""
+    if isinstance(o, (basestring, int, long, float)) or o is None:
+        return o
+    elif isinstance(o, list):
+        return [_simplejsonTypes(v) for v in o]
+    asdict = getattr(o, '_asdict', None)
+    if asdict is not None and callable(asdict):
+        o = asdict()
+    elif isinstance(o, tuple):
+        return [_simplejsonTypes(v) for v in o]
+    if isinstance(o, dict):
+        # An OrderedDict keeps the key order `o` iterates in.
+        return collections.OrderedDict((k, _simplejsonTypes(v)) for k, v in o.iteritems())
+    elif isinstance(o, decimal.Decimal):
+        return _decimalMarker + str(o)
+    return o
+
+
+def _stdlibEncoder(**options):
+    import json
+    encode = json.JSONEncoder(default=lambda o: _simplejsonTypes(defaultEncoder(o)), **options).encode
+
+    def encoder(o):
+        text = encode(_simplejsonTypes(o))
+        return _decimalMarkerRe.sub(r'\1', text) if _decimalMarker in text else text
+    return encoder
+
+
+def _stdlibBackend():
+    import json
+    compact = _stdlibEncoder(separators=(',', ':'))
+    pretty = _stdlibEncoder(indent=4, separators=(',', ': '))
+    return Backend('json', compact, pretty, json.loads)
+
+
+registerBackend('simplejson', _simplejsonBackend, priority=100)
+registerBackend('json', _stdlibBackend, priority=0)
+
+
+Point = collections.namedtuple('Point', ['x', 'y'])
+
+# Document exercising the cases where encoders tend to disagree, compared byte for byte by `checkParity`.
+paritySample = {
+    'str': 'plain "quoted" \\ text\n\t',
+    'unicode': u'caf\xe9 \u2603 \U0001f600',
+    'int': 12345678901234567890,
+    'float': [0.1, 1e-7, 1.5e300, -0.0, 3.141592653589793],
+    'bool': [True, False, None],
+    'datetime': datetime.datetime(2014, 10, 3, 12, 30, 45, 123456),
+    'date': datetime.date(2014, 10, 3),
+    'decimal': [decimal.Decimal('12.50'), decimal.Decimal('-1E+3'), decimal.Decimal('0.000001')],
+    'namedtuple': [Point(1, 2), Point(decimal.Decimal('0.5'), Point(3, 4))],
+    'nested': {'list': [1, [2, [3, {}]], []], 'tuple': (1, 'a'), 'empty': {}},
+    1: 'int key',
+}
+
+
+def checkParity(name, sample=None):
+    """
+    Compares the compact and pretty output of backend `name` with the canonical simplejson backend on `sample`.
+
+    :raises ParityError: if the outputs differ.
+    """
+    sample = paritySample if sample is None else sample
+    candidate, reference = _factories[name](), _simplejsonBackend()
+    for mode in ('compact', 'pretty'):
+        expected, actual = getattr(reference, mode)(sample), getattr(candidate, mode)(sample)
+        if actual != expected:
+            raise ParityError('{0} {1} output differs from simplejson:\n{2!r}\n{3!r}'.format(
+                name, mode, actual, expected))
+        if candidate.loads(actual) != reference.loads(expected):
+            raise ParityError('{0} does not load its {1} output like simplejson'.format(name, mode))
+
+
+def select():
+    """Returns the highest priority backend that is installed and passes `checkParity`."""
+    for name in sorted(_factories, key=lambda name: -_priorities[name]):
+        try:
+            if name != 'simplejson':
+                checkParity(name)
+            return _factories[name]()
+        except (ImportError, ParityError):
+            continue
+    return _stdlibBackend()
+
+
+def backend():
+    """Returns the active backend, selecting one on first use."""
+    global _current
+    if _current is None:
+        with _lock:
+            if _current is None:
+                _current = select()
+    return _current
+
+
+def setBackend(name):
+    """Forces backend `name`, e.g. to compare backends.  `None` restores automatic selection."""
+    global _current
+    with _lock:
+        _current = None if name is None else _factories[name]()
+
+
+def dumps(obj, pretty=False):
+    """Encodes `obj` to JSON with the active backend."""
+    b = backend()
+    return b.pretty(obj) if pretty else b.compact(obj)
+
+
+def loads(s):
+    """Decodes a JSON document with the active backend."""
+    return backend().loads(s)
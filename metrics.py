@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+"""
+A small Flask module recording per-endpoint, per-status request latency histograms.
+
+    from flashk_util.metrics import metrics
+    requestMetrics = metrics(app)                # or metrics(app, path='/metrics') to serve Prometheus text
+    requestMetrics.stats()                       # [EndpointStats(endpoint, status, count, sum, p50, p90, p99), ...]
+
+A request is timed until its response is closed, so the time to stream a body, e.g. a jsonifyStream or csvify export,
+is included; one failing with an unhandled exception is recorded as a 500 when its request context is torn down.  Latencies are counted into log-scale buckets, four per power of two of microseconds, so quantiles are
+accurate to about 10% from a microsecond to over an hour.  Each thread appends its durations to its own list without
+locking; they are counted into the shared histograms when read.
+
+The export lists every endpoint with its traffic and is not served unless asked for; put it behind authentication or
+on an internal-only listener.
+"""
+
+import bisect, collections, math, threading, time, timeit
+from flask import request
+from werkzeug.wsgi import ClosingIterator
+
+# time.perf_counter where available (Python 3), otherwise the best timer of the platform.
+clock = getattr(time, 'perf_counter', timeit.default_timer)
+
+# Buckets per power of two, and the number of powers of two of microseconds covered (2**32us is over an hour).
+subBuckets = 4
+_octaves = 32
+bucketCount = 1 + _octaves * subBuckets
+
+quantiles = (0.5, 0.9, 0.99)
+
+EndpointStats = collections.namedtuple('EndpointStats', ['endpoint', 'status', 'count', 'sum', 'p50', 'p90', 'p99'])
+
+
+def bucketBounds(i):
+    """Lower and upper bounds in seconds of bucket `i`."""
+    if i == 0:
+        return 0.0, 1e-6
+    octave, step = divmod(i - 1, subBuckets)
+    base = 2.0 ** octave * 1e-6
+    return base * (1 + float(step) / subBuckets), base * (1 + float(step + 1) / subBuckets)
+
+
+# Upper bounds of every bucket but the last, which takes everything longer.
+_upperBounds = [bucketBounds(i)[1] for i in xrange(bucketCount - 1)]
+
+
+def bucketIndex(seconds, _bisect=bisect.bisect_right, _bounds=_upperBounds):
+    """Bucket of a duration: 0 below a microsecond, then `subBuckets` per power of two of microseconds."""
+    return _bisect(_bounds, seconds)
+
+
+def quantile(buckets, q):
+    """Estimates quantile `q` of a merged bucket list (its last slot holds the sum) from bucket geometric midpoints."""
+    count = sum(buckets[:bucketCount])
+    if not count:
+        return None
+    rank = q * count
+    seen = 0
+    for i in xrange(bucketCount):
+        seen += buckets[i]
+        if seen >= rank and buckets[i]:
+            lower, upper = bucketBounds(i)
+            return math.sqrt(lower * upper) if lower else upper / 2
+    return bucketBounds(bucketCount - 1)[1]
+
+
+class LatencyHistograms(object):
+    """
+    Latency histograms keyed by `(endpoint, status)`.
+
+    A histogram is a list of `bucketCount` counts followed by the sum of the recorded durations.  A thread records by
+    appending to a list of its own, without locking; the pending durations of every thread are counted into the shared
+    histograms, under a lock, when they are read and whenever a thread has `foldEvery` of them.  The lists of threads
+    that have exited are dropped once counted.
+
+    :param foldEvery: durations a thread keeps pending before counting them itself, bounding their memory.
+    """
+    def __init__(self, foldEvery=1024):
+        self.foldEvery = foldEvery
+        self._local = threading.local()
+        # [(thread, pending durations)]; a thread only ever appends to its list, the lists are emptied under the lock.
+        self._threads = []
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def _threadSamples(self):
+        samples = self._local.samples = []
+        with self._lock:
+            # Also drops the lists of exited threads, which a thread per connection server would otherwise pile up.
+            self._fold()
+            self._threads.append((threading.current_thread(), samples))
+        return samples
+
+    def record(self, endpoint, status, seconds):
+        # This runs on every request: only an append, the bucket is found when the durations are counted.
+        try:
+            samples = self._local.samples
+        except AttributeError:
+            samples = self._threadSamples()
+        samples.append((endpoint, status, seconds))
+        if len(samples) >= self.foldEvery:
+            with self._lock:
+                self._fold()
+
+    def _fold(self, _bisect=bisect.bisect_right, _bounds=_upperBounds):
+        # Called with the lock held.
+        histograms = self._histograms
+        live = []
+        for thread, samples in self._threads:
+            # Checked before taking the durations: a thread seen to have exited has nothing left to append.
+            if thread.is_alive():
+                live.append((thread, samples))
+            n = len(samples)
+            pending = samples[:n]
+            del samples[:n]
+            for endpoint, status, seconds in pending:
+                h = histograms.get((endpoint, status))
+                if h is None:
+                    h = histograms[(endpoint, status)] = [0] * bucketCount + [0.0]
+                h[_bisect(_bounds, seconds)] += 1
+                h[-1] += seconds
+        self._threads = live
+
+    def merged(self):
+        """Returns `{(endpoint, status): buckets}` summed over every thread."""
+        with self._lock:
+            self._fold()
+            return dict((key, list(h)) for key, h in self._histograms.iteritems())
+
+    def stats(self):
+        """Returns an `EndpointStats` per endpoint and status, sorted by endpoint and status."""
+        out = []
+        for (endpoint, status), buckets in sorted(self.merged().items()):
+            out.append(EndpointStats(endpoint, status, sum(buckets[:bucketCount]), buckets[-1],
+                *[quantile(buckets, q) for q in quantiles]))
+        return out
+
+    def clear(self):
+        with self._lock:
+            for thread, samples in self._threads:
+                del samples[:len(samples)]
+            self._histograms.clear()
+
+    def prometheus(self, name='http_request_duration_seconds'):
+        """Renders the histograms in the Prometheus text exposition format, as a summary per endpoint and status."""
+        lines = [
+            '# HELP {0} Request latency by Flask endpoint and response status.'.format(name),
+            '# TYPE {0} summary'.format(name),
+        ]
+        for stat in self.stats():
+            labels = 'endpoint="{0}",status="{1}"'.format(_escapeLabel(stat.endpoint), stat.status)
+            for q, value in zip(quantiles, stat[4:]):
+                lines.append('{0}{{{1},quantile="{2}"}} {3!r}'.format(name, labels, q, value))
+            lines.append('{0}_sum{{{1}}} {2!r}'.format(name, labels, stat.sum))
+            lines.append('{0}_count{{{1}}} {2}'.format(name, labels, stat.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _escapeLabel(value):
+    return unicode(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n').encode('utf-8')
+
+
+def metrics(app, path=None, histograms=None):
+    """
+    Records the latency of every request to `app`, and serves the Prometheus text export at `path` if one is given.
+
+    :return: the `LatencyHistograms`, also available as `app.extensions['metrics']`.
+    """
+    histograms = histograms or LatencyHistograms()
+    app.extensions['metrics'] = histograms
+    environKey = 'flashk_util.metrics.start'
+
+    @app.before_request
+    def _metricsStart():
+        request.environ[environKey] = clock()
+
+    @app.after_request
+    def _metricsRecord(response):
+        started = request.environ.pop(environKey, None)
+        if started is None:
+            return response
+        endpoint, status = request.endpoint or '<unmatched>', response.status_code
+
+        def record():
+            histograms.record(endpoint, status, clock() - started)
+
+        if response.direct_passthrough:
+            # werkzeug hands a passthrough body, e.g. from send_file, to the server as is and never runs the
+            # `call_on_close` callbacks for it.  Wrapping it also keeps a server from using sendfile on it.
+            response.response = ClosingIterator(response.response, record)
+        else:
+            response.call_on_close(record)
+        return response
+
+    @app.teardown_request
+    def _metricsRecordError(exc):
+        # An unhandled exception skips `after_request` (Flask 0.12), leaving the start time behind; the client is
+        # answered with a 500.
+        started = request.environ.pop(environKey, None)
+        if started is not None and exc is not None:
+            histograms.record(request.endpoint or '<unmatched>', 500, clock() - started)
+
+    if path is not None:
+        @app.route(path, endpoint='metrics')
+        def _metricsExport():
+            return app.response_class(histograms.prometheus(), mimetype='text/plain; version=0.0.4')
+
+    return histograms
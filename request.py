@@ -4,23 +4,37 @@ __author__ = 'brock'
 Taken from:  https://gist.github.com/1094140
 """
 
+import collections, datetime, decimal, threading, time
 from functools import wraps
 from flask import request, current_app
 from werkzeug.routing import BaseConverter
 from werkzeug.exceptions import HTTPException
+from . import crypto, jsonbackend
 
 def jsonp(func):
-    """Wraps JSONified output for JSONP requests."""
+    """
+    Wraps JSONified output for JSONP requests.
+
+    The view may return a response, or a dict which is encoded with the active :mod:`jsonbackend`.
+    """
     @wraps(func)
     def decorated_function(*args, **kwargs):
         callback = request.args.get('callback', False)
+        result = func(*args, **kwargs)
+        if isinstance(result, dict):
+            data = jsonbackend.dumps(result)
+        elif callback:
+            data = str(result.data)
+        else:
+            return result
+
         if callback:
-            data = str(func(*args, **kwargs).data)
             content = str(callback) + '(' + data + ')'
             mimetype = 'application/javascript'
-            return current_app.response_class(content, mimetype=mimetype)
         else:
-            return func(*args, **kwargs)
+            content = data
+            mimetype = 'application/json'
+        return current_app.response_class(content, mimetype=mimetype)
     return decorated_function
 
 
@@ -50,7 +64,7 @@ def getClientIP(request):
     :return str: The client IP address, or none if neither the X-Forwarded-For
        header, nor REMOTE_ADDR are present in the environment.
     """
-    if request.access_route > 0:
+    if request.access_route:
         ip = request.access_route[0]
     else:
         ip = None
@@ -152,19 +166,244 @@ class NotImplemented(ShHTTPException):
         'browser.</p>'
     )
 
-def paginate(request, objects, total, offset, limit):
+class Cursor(collections.namedtuple('Cursor', ['key', 'direction'])):
+    """
+    A decoded keyset pagination cursor.
+
+    `key` is the sort key of the last object of the previous page when `direction` is 'next', or of the first object
+    of the following page when it is 'previous'.  Views select the `limit` objects sorted after (or before) `key`.
+    """
+    __slots__ = ()
+
+    NEXT = 'next'
+    PREVIOUS = 'previous'
+
+
+# Seconds a cursor stays valid.
+cursorLifetime = 7 * 24 * 3600
+
+_cursorPurpose = 'cursor'
+_cursorDirections = {Cursor.NEXT: 'n', Cursor.PREVIOUS: 'p'}
+_cursorDatetimeFormat = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+class _UTC(datetime.tzinfo):
+    """UTC, for timezone-aware cursor keys."""
+    def utcoffset(self, dt):
+        return datetime.timedelta(0)
+
+    def tzname(self, dt):
+        return 'UTC'
+
+    def dst(self, dt):
+        return datetime.timedelta(0)
+
+    def __repr__(self):
+        return '<UTC>'
+
+_utc = _UTC()
+
+
+def _encodeCursorKey(value):
+    """Makes a sort key JSON-safe, tagging the types JSON can't represent so `_decodeCursorKey` restores them."""
+    if isinstance(value, (tuple, list)):
+        return [_encodeCursorKey(v) for v in value]
+    elif isinstance(value, datetime.datetime):
+        if value.utcoffset() is not None:
+            # Aware keys travel as UTC and come back as aware UTC datetimes, which compare equal to the original.
+            return {'dtz': value.astimezone(_utc).replace(tzinfo=None).strftime(_cursorDatetimeFormat)}
+        return {'dt': value.strftime(_cursorDatetimeFormat)}
+    elif isinstance(value, datetime.date):
+        return {'d': value.isoformat()}
+    elif isinstance(value, decimal.Decimal):
+        return {'dec': str(value)}
+    return value
+
+
+def _decodeCursorKey(value):
+    if isinstance(value, list):
+        return tuple(_decodeCursorKey(v) for v in value)
+    elif isinstance(value, dict):
+        if 'dt' in value:
+            return datetime.datetime.strptime(value['dt'], _cursorDatetimeFormat)
+        elif 'dtz' in value:
+            return datetime.datetime.strptime(value['dtz'], _cursorDatetimeFormat).replace(tzinfo=_utc)
+        elif 'd' in value:
+            return datetime.datetime.strptime(value['d'], '%Y-%m-%d').date()
+        return decimal.Decimal(value['dec'])
+    return value
+
+
+def encodeCursor(request, key, direction=Cursor.NEXT):
+    """Returns an opaque cursor for sort `key`, signed with `crypto` and bound to the request path."""
+    return crypto.dict2signed({
+        'p': _cursorPurpose,
+        'u': request.path,
+        'k': _encodeCursorKey(key),
+        'd': _cursorDirections[direction],
+    })
+
+
+def decodeCursor(request, cursor):
+    """
+    Verifies and decodes a cursor made by `encodeCursor` for the current request path.
+
+    :raises BadRequest: if the cursor is forged, expired, malformed or was issued for another path.
+    """
+    try:
+        data = crypto.signed2dict(cursor.encode('ascii'), cursorLifetime)
+        if data['p'] != _cursorPurpose or data['u'] != request.path:
+            raise ValueError(cursor)
+        direction = Cursor.NEXT if data['d'] == 'n' else Cursor.PREVIOUS if data['d'] == 'p' else None
+        if direction is None:
+            raise ValueError(cursor)
+        return Cursor(_decodeCursorKey(data['k']), direction)
+    except Exception:
+        raise BadRequest(description='Invalid or expired cursor')
+
+
+class Estimate(collections.namedtuple('Estimate', ['value'])):
+    """An approximate `paginate` total, e.g. from the query planner or table statistics rather than a COUNT(*)."""
+    __slots__ = ()
+
+
+class CountCache(object):
+    """
+    Bounded, thread-safe LRU of `paginate` totals keyed by scope, request path and filter arguments, so the count
+    query behind a listing runs at most once per `ttl` seconds rather than once per page.
+
+    The path and arguments alone don't say whose rows were counted.  Listings whose rows depend on the user or account,
+    such as `/contacts`, require a `scope` returning that user or account, otherwise every tenant is served the first
+    tenant's total::
+
+        contactCounts = CountCache(scope=lambda request: g.user.accountId)
+
+    :param ttl: seconds a count stays cached.
+    :param maxEntries: maximum number of cached counts.
+    :param ignoreArgs: request arguments that select a page rather than filter the result set.
+    :param scope: callable taking the request and returning a hashable value the count depends on besides the path and
+        arguments, e.g. the user or account id.  None shares counts between every caller, for public listings only.
+    """
+    def __init__(self, ttl=60, maxEntries=10000, ignoreArgs=('offset', 'limit', 'cursor', 'sort', 'order', 'callback'),
+                 scope=None):
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.ignoreArgs = frozenset(ignoreArgs)
+        self.scope = scope
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __repr__(self):
+        return '<CountCache: {0} entries, {1} hits, {2} misses>'.format(len(self), self.hits, self.misses)
+
+    def key(self, request):
+        args = sorted((k, tuple(v)) for k, v in request.args.iterlists() if k not in self.ignoreArgs)
+        scope = self.scope(request) if self.scope is not None else None
+        return scope, request.path, tuple(args)
+
+    def get(self, key):
+        """Returns the cached count for `key`, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or time.time() - entry[1] > self.ttl:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, count):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (count, time.time())
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def count(self, request, counter):
+        """Returns the cached count for the request, calling `counter()` and caching its result on a miss."""
+        key = self.key(request)
+        count = self.get(key)
+        if count is None:
+            count = counter()
+            if count is not None:
+                self.put(key, count)
+        return count
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+def _sortKeyGetter(sortKey):
+    if callable(sortKey):
+        return sortKey
+    return lambda obj: obj[sortKey] if isinstance(obj, dict) else getattr(obj, sortKey)
+
+
+def paginate(request, objects, total, offset, limit, sortKey=None, cursor=None, countCache=None, extraRow=False):
+    """
+    Builds the paginated response dict for `objects`, the current page.
+
+    `total` may be an int, an `Estimate`, None when unknown, or a callable returning one of those, which is only
+    called on a `countCache` miss when a `CountCache` is given.  `meta.approximate` is set unless the total is exact.
+
+    With `extraRow`, `objects` holds up to `limit + 1` rows: the view fetched one row more than it shows, and
+    `meta.hasMore`, and with it the `next` link, reflect whether that row exists.  The extra row is dropped from the
+    response; it is the last row, or the first for a previous-page cursor (fetched backwards then reversed).  Without
+    it, cursor pages and unknown or estimated totals assume another page follows a full one.
+
+    By default `next` and `previous` are offset links.  Given a `sortKey`, a callable or the name of a key/attribute
+    of each object, they are cursor links instead, carrying the signed sort key of the last (or first) object so the
+    next page can be selected with a keyset condition rather than an OFFSET.  `cursor` is the `Cursor` the current
+    page was selected with, if any, see `helpers.getViewWindowParams`.  Offset links keep working for clients that
+    send `offset`.
+    """
     def get_url(offset, limit):
         return '{}?&offset={}&limit={}'.format(request.path, offset, limit)
 
+    def get_cursor_url(obj, direction):
+        return '{}?cursor={}&limit={}'.format(request.path, encodeCursor(request, getKey(obj), direction), limit)
+
+    if callable(total):
+        total = countCache.count(request, total) if countCache is not None else total()
+    approximate = total is None or isinstance(total, Estimate)
+    if isinstance(total, Estimate):
+        total = total.value
+
+    backwards = cursor is not None and cursor.direction == Cursor.PREVIOUS
+    if extraRow:
+        hasMore = len(objects) > limit
+        if hasMore:
+            objects = objects[-limit:] if backwards else objects[:limit]
+    elif approximate or sortKey is not None:
+        hasMore = len(objects) >= limit
+    else:
+        hasMore = offset + limit < total
+
+    if sortKey is None:
+        nextUrl = get_url(offset + limit, limit) if hasMore else None
+        previousUrl = get_url(offset - limit, limit) if offset - limit >= 0 else None
+    else:
+        # Going backwards, `hasMore` refers to the rows before this page.
+        getKey = _sortKeyGetter(sortKey)
+        nextUrl = get_cursor_url(objects[-1], Cursor.NEXT) if objects and (hasMore or backwards) else None
+        hasPrevious = hasMore if backwards else cursor is not None or offset > 0
+        previousUrl = get_cursor_url(objects[0], Cursor.PREVIOUS) if objects and hasPrevious else None
+
     response = {
         'meta': {
             'total': total,
             'limit': limit,
-            'next': get_url(offset + limit, limit)
-            if offset + limit < total else None,
-            'previous': get_url(offset - limit, limit)
-            if offset - limit >= 0 else None,
+            'next': nextUrl,
+            'previous': previousUrl,
             'offset': offset,
+            'approximate': approximate,
+            'hasMore': hasMore,
         },
         'objects': objects
     }
@@ -1,22 +1,26 @@
-from flask import jsonify
+from flask import current_app
 from werkzeug.exceptions import HTTPException
 from werkzeug.exceptions import default_exceptions
+from . import jsonbackend
 
 
 def make_json_error(ex):
     """
     Create a json response from an Exception. If the exception is an
     HTTPException, the response.status_code will be that of the
-    HTTPException, otherwise it will be 500.
+    HTTPException, otherwise it will be 500. The body is compact JSON
+    from :mod:`jsonbackend`, with keys in dict order rather than Flask's
+    sorted and indented `jsonify` output.
     :param ex:Exception instance
     :return:json response
     """
 
     if isinstance(ex, HTTPException):
-        response = jsonify(message=str(ex), code=ex.code)
+        body = dict(message=str(ex), code=ex.code)
     else:
-        response = jsonify(message=str(ex))
+        body = dict(message=str(ex))
 
+    response = current_app.response_class(jsonbackend.dumps(body), mimetype='application/json')
     response.status_code = (ex.code if isinstance(ex, HTTPException) else 500)
     return response
 
@@ -2,21 +2,239 @@
 
 """Extend werkzeug request handler to suit our needs."""
 
-import time
-from werkzeug.serving import BaseRequestHandler
+import logging, Queue, signal, socket, threading, time
+from werkzeug.serving import BaseRequestHandler, BaseWSGIServer
+
+_logger = None
+_loggerLock = threading.Lock()
+
+
+def _requestLogger():
+    """
+    Returns the 'werkzeug' logger, set up the way werkzeug sets it up for its own request lines: at INFO level when none
+    is set, with a stderr handler when no handler would print its records.
+    """
+    global _logger
+    if _logger is None:
+        with _loggerLock:
+            if _logger is None:
+                logger = logging.getLogger('werkzeug')
+                if logger.level == logging.NOTSET:
+                    logger.setLevel(logging.INFO)
+                level, current, handled = logger.getEffectiveLevel(), logger, False
+                while current and not handled:
+                    handled = any(handler.level <= level for handler in current.handlers)
+                    current = current.parent if current.propagate else None
+                if not handled:
+                    logger.addHandler(logging.StreamHandler())
+                _logger = logger
+    return _logger
+
+
+class _CountingWriter(object):
+    """Wraps a handler's `wfile`, counting the bytes written through it."""
+    def __init__(self, raw):
+        self.raw = raw
+        self.count = 0
+
+    def write(self, data):
+        self.count += len(data)
+        self.raw.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
 
 class ShRequestHandler(BaseRequestHandler):
-    """Extend werkzeug request handler to suit our needs."""
-    def handle(self):
+    """
+    Extend werkzeug request handler to suit our needs.
+
+    Each request is timed in phases:
+
+        read   parsing the request line and headers
+        app    from the parsed request to the application's first write, its time to first byte
+        write  from the first write to the end of the response body, e.g. streaming a large csvify export
+
+    The read and app phases are sent to the client in a `Server-Timing` header.  Once the response is complete a log
+    line gives the total time, body bytes and every phase, and its record carries them as a `requestTiming` dict for
+    structured log formatters.
+    """
+    def setup(self):
+        super(ShRequestHandler, self).setup()
+        self.wfile = _CountingWriter(self.wfile)
+
+    def parse_request(self):
+        # Timed from here rather than from `handle` so each request on a keep-alive connection is timed on its own,
+        # without the time spent waiting for it.
         self.shRequestStarted = time.time()
-        rv = super(ShRequestHandler, self).handle()
+        rv = super(ShRequestHandler, self).parse_request()
+        if self.shRequestParsed is None:
+            self.shRequestParsed = time.time()
+        return rv
+
+    def handle_one_request(self):
+        self.shRequestStarted = self.shRequestParsed = self.shRequestProcessed = None
+        self.shResponseCode = None
+        rv = super(ShRequestHandler, self).handle_one_request()
+        if self.shResponseCode is not None:
+            self.logTiming(time.time())
+        if getattr(self.server, 'draining', False):
+            self.close_connection = 1
         return rv
 
     def send_response(self, *args, **kw):
         self.shRequestProcessed = time.time()
+        rejected = self.shRequestParsed is None
+        if rejected:
+            # A malformed request answered by `send_error` from within `parse_request`.
+            self.shRequestParsed = self.shRequestProcessed
         super(ShRequestHandler, self).send_response(*args, **kw)
+        if not rejected and self.request_version != 'HTTP/0.9':
+            self.send_header('Server-Timing', 'read;dur={0:.3f}, app;dur={1:.3f}'.format(
+                (self.shRequestParsed - self.shRequestStarted) * 1000,
+                (self.shRequestProcessed - self.shRequestParsed) * 1000))
+
+    def end_headers(self):
+        super(ShRequestHandler, self).end_headers()
+        self.shBodyStart = self.wfile.count
 
     def log_request(self, code='-', size='-'):
-        duration = int((self.shRequestProcessed - self.shRequestStarted) * 1000)
-        self.log('info', u'"{0}" {1} {2} [{3}ms]'.format(self.requestline.replace('%', '%%'), code, size, duration))
+        # Called as the response starts; the request is logged by `logTiming` once its body is written.
+        self.shResponseCode = code
+
+    def requestTiming(self, finished):
+        """Returns the phase durations in milliseconds and the body size of the current request."""
+        started, parsed = self.shRequestStarted, self.shRequestParsed
+        ms = lambda seconds: round(seconds * 1000, 3)
+        return {
+            'method': getattr(self, 'command', None),
+            'path': getattr(self, 'path', None),
+            'status': self.shResponseCode,
+            'bytes': self.wfile.count - getattr(self, 'shBodyStart', self.wfile.count),
+            'read': ms(parsed - started),
+            'app': ms(self.shRequestProcessed - parsed),
+            'write': ms(finished - self.shRequestProcessed),
+            'total': ms(finished - started),
+        }
+
+    def logTiming(self, finished):
+        timing = self.requestTiming(finished)
+        message = u'"{0}" {1} {2} [{3}ms] read={4}ms app={5}ms write={6}ms'.format(
+            self.requestline, timing['status'], timing['bytes'], int(timing['total']), timing['read'], timing['app'],
+            timing['write'])
+        _requestLogger().info('%s - - [%s] %s', self.address_string(), self.log_date_time_string(), message,
+            extra={'requestTiming': timing})
+
+
+class ShThreadPoolServer(BaseWSGIServer):
+    """
+    WSGI server handing connections to a fixed pool of worker threads.
+
+    Connections speak HTTP/1.1 and are kept alive between requests until they sit idle for `keepAliveTimeout`
+    seconds; a connection holds its worker while it is open.  When every worker is busy the accept loop stops
+    accepting and new connections wait in the listen backlog.  SIGTERM (when served from the main thread) or
+    `shutdown` stops accepting, lets in-flight requests finish for up to `drainTimeout` seconds in all and closes
+    kept-alive connections after their current request; an accepted connection still waiting for a worker is closed.
+
+        ShThreadPoolServer('0.0.0.0', 8080, app, workers=32).serve_forever()
+
+    :param workers: number of worker threads.
+    :param backlog: listen backlog, connections the kernel queues while the workers are busy.
+    :param keepAliveTimeout: seconds a connection may wait for its next request.
+    :param drainTimeout: seconds to wait for in-flight requests when shutting down.
+    """
+    multithread = True
+
+    # Seconds between checks for a shutdown while a connection waits for a free worker.
+    _handoffPoll = 0.5
+
+    def __init__(self, host, port, app, workers=16, backlog=128, keepAliveTimeout=5, drainTimeout=30,
+                 handler=ShRequestHandler, **kw):
+        self.request_queue_size = backlog
+        self.workers = workers
+        self.keepAliveTimeout = keepAliveTimeout
+        self.drainTimeout = drainTimeout
+        self.draining = False
+        # HTTP/1.1 enables keep-alive; the handler timeout is applied to the socket, bounding idle waits.  A buffered
+        # wfile sends the status line, headers and body of a response in one write.
+        handler = type(handler.__name__, (handler,), {
+            'protocol_version': 'HTTP/1.1',
+            'timeout': keepAliveTimeout,
+            'wbufsize': -1,
+        })
+        super(ShThreadPoolServer, self).__init__(host, port, app, handler, **kw)
+        self._connections = Queue.Queue(maxsize=workers)
+        self._threads = []
+
+    def _work(self):
+        while True:
+            item = self._connections.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def get_request(self):
+        connection, address = super(ShThreadPoolServer, self).get_request()
+        if connection.family in (socket.AF_INET, socket.AF_INET6):
+            # Responses are flushed whole; Nagle's algorithm would only delay them on kept-alive connections.
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection, address
+
+    def process_request(self, request, client_address):
+        # Blocks while every worker is busy, leaving further connections in the listen backlog.  The wait is cut into
+        # short timeouts so a shutdown isn't held up until a worker frees; the connection is then closed unserved.
+        while True:
+            try:
+                self._connections.put((request, client_address), timeout=self._handoffPoll)
+                return
+            except Queue.Full:
+                if self.draining:
+                    self.shutdown_request(request)
+                    return
+
+    def shutdown(self):
+        self.draining = True
+        super(ShThreadPoolServer, self).shutdown()
+
+    def _onSigterm(self, signum, frame):
+        self.log('info', 'SIGTERM received, draining')
+        self.draining = True
+        # `shutdown` waits for the serve loop to exit, which runs in this very thread.
+        threading.Thread(target=self.shutdown).start()
+
+    def serve_forever(self):
+        for i in xrange(self.workers - len(self._threads)):
+            thread = threading.Thread(target=self._work, name='ShThreadPoolServer-{0}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        if isinstance(threading.current_thread(), threading._MainThread):
+            signal.signal(signal.SIGTERM, self._onSigterm)
+        try:
+            super(ShThreadPoolServer, self).serve_forever()
+        finally:
+            self.drain()
 
+    def drain(self):
+        """Stops the workers once their queued and in-flight connections are done, waiting up to `drainTimeout`."""
+        self.draining = True
+        deadline = time.time() + self.drainTimeout
+        for thread in self._threads:
+            # The queue is bounded: while every worker is busy a stop marker waits for a free slot, but not past the
+            # deadline.
+            try:
+                self._connections.put(None, timeout=max(0, deadline - time.time()))
+            except Queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(max(0, deadline - time.time()))
+        self._threads = [thread for thread in self._threads if thread.is_alive()]
+        if self._threads:
+            self.log('warning', '%d workers still busy after draining for %ss', len(self._threads), self.drainTimeout)
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for flashk_util, run with:
+
+    python -m unittest discover -s flashk_util/tests -t .
+"""
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""Parity of every registered JSON backend with the canonical simplejson output."""
+
+import collections, datetime, decimal, unittest
+from .. import jsonbackend
+
+Point = collections.namedtuple('Point', ['x', 'y'])
+
+
+def installedBackends():
+    backends = []
+    for name in sorted(jsonbackend._factories):
+        try:
+            backends.append(jsonbackend._factories[name]())
+        except ImportError:
+            continue
+    return backends
+
+
+class BackendParityTest(unittest.TestCase):
+    cases = {
+        'floats': [0.1, 1e-7, 1.5e300, -0.0, 2.0, 3.141592653589793, -123456.789],
+        'decimals': [decimal.Decimal('12.50'), decimal.Decimal('-1E+3'), decimal.Decimal('0.000001'),
+            decimal.Decimal('0'), {'price': decimal.Decimal('19.99')}],
+        'namedtuples': [Point(1, 2), Point(Point(3, 4), [Point(5, 6)]), {'point': Point('a', None)}],
+        'unicode': [u'caf\xe9', u'☃', u'\U0001f600', 'plain "quoted" \\ text\n\t', u'\x00\x1f', {u'cl\xe9': 1}],
+        'datetimes': [datetime.datetime(2014, 10, 3, 12, 30, 45, 123456), datetime.datetime(2014, 10, 3),
+            datetime.date(2014, 10, 3)],
+        'mixed': {'objects': [{'id': 1, 'total': decimal.Decimal('1.10'), 'at': datetime.date(2014, 1, 1),
+            'where': Point(1.5, -2)}], 'tuple': (1, 'a'), 'empty': [{}, [], ()], 'big': 12345678901234567890},
+    }
+
+    def setUp(self):
+        self.reference = jsonbackend._simplejsonBackend()
+        self.backends = installedBackends()
+
+    def assertParity(self, value):
+        for mode in ('compact', 'pretty'):
+            expected = getattr(self.reference, mode)(value)
+            for backend in self.backends:
+                actual = getattr(backend, mode)(value)
+                self.assertEqual(actual, expected,
+                    '{0} {1}: {2!r} != {3!r}'.format(backend.name, mode, actual, expected))
+                self.assertEqual(backend.loads(actual), self.reference.loads(expected))
+
+    def testStdlibIsRegistered(self):
+        self.assertIn('json', [backend.name for backend in self.backends])
+
+    def testFloats(self):
+        self.assertParity(self.cases['floats'])
+
+    def testDecimals(self):
+        self.assertParity(self.cases['decimals'])
+
+    def testNamedtuples(self):
+        self.assertParity(self.cases['namedtuples'])
+
+    def testUnicode(self):
+        self.assertParity(self.cases['unicode'])
+
+    def testDatetimes(self):
+        self.assertParity(self.cases['datetimes'])
+
+    def testMixed(self):
+        self.assertParity(self.cases['mixed'])
+
+    def testParitySample(self):
+        self.assertParity(jsonbackend.paritySample)
+
+    def testCheckParity(self):
+        for backend in self.backends:
+            jsonbackend.checkParity(backend.name)
+
+
+class CanonicalOutputTest(unittest.TestCase):
+    """The canonical form is what `jsonify` wrote with simplejson before backends existed."""
+    def testDecimalsAreNumbersAndNamedtuplesAreObjects(self):
+        value = collections.OrderedDict([('d', decimal.Decimal('12.50')), ('p', Point(1, 2))])
+        for backend in installedBackends():
+            self.assertEqual(backend.compact(value), '{"d":12.50,"p":{"x":1,"y":2}}', backend.name)
+            self.assertEqual(backend.pretty(value),
+                '{\n    "d": 12.50,\n    "p": {\n        "x": 1,\n        "y": 2\n    }\n}', backend.name)
+
+    def testMatchesPlainSimplejson(self):
+        import simplejson
+        from sh_util.json import defaultEncoder
+        value = BackendParityTest.cases['mixed']
+        self.assertEqual(jsonbackend._simplejsonBackend().pretty(value),
+            simplejson.dumps(value, indent=4, default=defaultEncoder))
+
+    def testDecimalMarkerIsNotLeaked(self):
+        text = jsonbackend._stdlibBackend().compact([decimal.Decimal('1.0'), u'decimal'])
+        self.assertEqual(text, '[1.0,"decimal"]')
+
+
+class SelectionTest(unittest.TestCase):
+    def tearDown(self):
+        jsonbackend._factories.pop('broken', None)
+        jsonbackend._priorities.pop('broken', None)
+        jsonbackend.setBackend(None)
+
+    def testBackendFailingParityIsSkipped(self):
+        def broken():
+            return jsonbackend.Backend('broken', lambda o: '{}', lambda o: '{}', lambda s: {})
+        jsonbackend.registerBackend('broken', broken, priority=1000)
+        self.assertRaises(jsonbackend.ParityError, jsonbackend.checkParity, 'broken')
+        self.assertNotEqual(jsonbackend.backend().name, 'broken')
+
+
+if __name__ == '__main__':
+    unittest.main()